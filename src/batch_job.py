@@ -12,8 +12,12 @@ else:
     task_id    = 0
 
 
-filelist = os.listdir(datadirectory)
-myfilelist = filelist[task_id-task_min : : task_count]
-print('processor %d of %d has %d files' % (task_id-task_min, task_count, len(myfilelist)))
-process_list(myfilelist)
+if __name__ == "__main__":
+    filelist = os.listdir(datadirectory)
+    myfilelist = filelist[task_id-task_min : : task_count]
+    print('processor %d of %d has %d files' % (task_id-task_min, task_count, len(myfilelist)))
+    workers = int(os.environ.get('SLURM_CPUS_PER_TASK', n_workers))
+    process_list(myfilelist, workers=workers)
+    # Guarded so that worker processes started with spawn (Windows) or
+    # forkserver can import this script without starting a run
 
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+This script benchmarks the image processing stages of Fire Opal on synthetic
+frames, without RAW files or network access.
+
+Structure:
+    - Defines functions that generate synthetic star fields with injected
+    satellite streaks and clouds
+    - Times convert_to_grey, bayer_to_grey, cloudy_or_clear, detect_lines,
+    group_segments and line_from_two_points separately and end-to-end
+    - Reports throughput, peak memory, cloud check accuracy, detection
+    recall on the injected streaks and the number of rows each found streak
+    was split into
+
+Usage:
+    python fire_opal_benchmark.py --frames 10 --width 6000 --height 4000
+
+Requirements:
+    fire_opal_v2 (and therefore fire_opal_settings.py), cv2, numpy
+
+"""
+import argparse, json, time, types
+import numpy as np
+import cv2
+import fire_opal_v2 as fo
+from fire_opal_metrics import peak_memory
+
+
+
+def synthetic_frame(rng, width, height, n_stars=3000, n_streaks=1, cloudy=False):
+
+    """
+    This function makes a synthetic RGB night sky image. Stars are Gaussian
+    points with random brightness on a noisy background. Streaks are straight
+    lines of random length, angle and brightness. A cloudy frame has a bright,
+    smooth glow over the whole image and stars and streaks dimmed almost to
+    nothing.
+
+    Inputs: numpy random generator, image width and height, number of stars,
+    number of streaks, True for a cloudy frame
+    Outputs: uint8 RGB image, list of (x1, y1, x2, y2) injected streaks
+
+    """
+    sky = np.zeros((height, width), 'float32')
+    xs = rng.integers(0, width, n_stars)
+    ys = rng.integers(0, height, n_stars)
+    sky[ys, xs] = rng.uniform(400, 4000, n_stars)
+    # Point sources, spread into stars by the blur below
+
+    streaks = []
+    for _ in range(n_streaks):
+        length = rng.uniform(300, 1200)
+        angle = rng.uniform(0, np.pi)
+        cx = rng.uniform(length/2, width - length/2)
+        cy = rng.uniform(length/2, height - length/2)
+        x1, y1 = cx - np.cos(angle)*length/2, cy - np.sin(angle)*length/2
+        x2, y2 = cx + np.cos(angle)*length/2, cy + np.sin(angle)*length/2
+        cv2.line(sky, (int(x1), int(y1)), (int(x2), int(y2)), float(rng.uniform(400, 900)), 2)
+        streaks.append((x1, y1, x2, y2))
+
+    sky = cv2.GaussianBlur(sky, (0, 0), 1.2)
+    if cloudy:
+        glow = cv2.resize(rng.uniform(60, 140, (height//500 + 2, width//500 + 2)).astype('float32'),
+                          (width, height), interpolation=cv2.INTER_CUBIC)
+        sky = sky*0.02 + glow
+        # Clouds hide the stars and light up the background
+    sky += rng.normal(20, 4, (height, width)).astype('float32')
+    grey = np.clip(sky, 0, 255).astype('uint8')
+    return np.repeat(grey[:, :, None], 3, axis=2), streaks
+
+
+
+def synthetic_raw(rgbimage):
+
+    """
+    Makes an object that looks like a rawpy RAW image to bayer_to_grey, with
+    the green channel of the synthetic frame scaled to 14 bit Bayer data in
+    an RGGB pattern and a neutral white balance.
+
+    """
+    bayer = (rgbimage[:, :, 1].astype('uint16')*64 + 600).clip(0, 16383)
+    return types.SimpleNamespace(raw_image_visible=bayer,
+                                 raw_colors_visible=np.array([[0, 1], [3, 2]], 'uint8'),
+                                 daylight_whitebalance=[1., 1., 1., 0.],
+                                 black_level_per_channel=[600, 600, 600, 600],
+                                 white_level=16383)
+
+
+
+def distance_to_segment(px, py, x1, y1, x2, y2):
+
+    """ Distance in pixels from point (px, py) to the segment (x1, y1)-(x2, y2). """
+
+    dx, dy = x2 - x1, y2 - y1
+    t = np.clip(((px - x1)*dx + (py - y1)*dy)/max(dx*dx + dy*dy, 1e-9), 0., 1.)
+    return np.hypot(px - (x1 + t*dx), py - (y1 + t*dy))
+
+
+
+def match_streaks(injected, detected, tolerance=15.):
+
+    """
+    Counts the injected streaks that were detected. A detected streak
+    matches an injected streak if both of its endpoints lie within tolerance
+    pixels of the injected streak. A streak that is split into several
+    detections would become several rows of streak data, so the number of
+    detections matching each injected streak is also returned.
+
+    Inputs: list of injected streaks, list of detected streaks, tolerance
+    Outputs: number of injected streaks found, number of detections that do
+    not match any injected streak, list of the number of detections matching
+    each injected streak
+
+    """
+    rows = [0]*len(injected)
+    false = 0
+    for x1, y1, x2, y2 in detected:
+        matches = [i for i, streak in enumerate(injected)
+                   if distance_to_segment(x1, y1, *streak) < tolerance
+                   and distance_to_segment(x2, y2, *streak) < tolerance]
+        for i in matches:
+            rows[i] += 1
+        if not matches:
+            false += 1
+    return sum(count > 0 for count in rows), false, rows
+
+
+
+def frame_tiles(width, height, tiles=fo.cl_tiles):
+
+    """
+    Returns the cloud check tiles for a frame of the given size: the tiles of
+    the settings if they all lie inside the frame, otherwise one tile of the
+    same size (at most half the frame) in the centre of the frame.
+
+    """
+    if all(r2 <= height and c2 <= width for r1, r2, c1, c2 in tiles):
+        return tiles
+    r1, r2, c1, c2 = tiles[0]
+    rows, cols = min(r2 - r1, height//2), min(c2 - c1, width//2)
+    top, left = (height - rows)//2, (width - cols)//2
+    return [(top, top + rows, left, left + cols)]
+
+
+
+def timed(times, name, function, *args):
+
+    """ Calls function(*args), adds the wall time to times[name] and returns the result. """
+
+    start = time.perf_counter()
+    result = function(*args)
+    times.setdefault(name, []).append(time.perf_counter() - start)
+    return result
+
+
+
+def run_benchmark(frames=10, width=6000, height=4000, cloudy_fraction=0.3, streaks_per_frame=1, seed=1):
+
+    """
+    Generates synthetic frames and runs the Fire Opal image processing
+    stages on each of them.
+
+    Inputs: number of frames, image width and height, fraction of cloudy
+    frames, number of streaks injected in each clear frame, random seed
+    Output: dictionary of results
+
+    """
+    rng = np.random.default_rng(seed)
+    tiles = frame_tiles(width, height)
+    times = {}
+    injected_total = found_total = false_total = 0
+    rows_per_streak = []
+    clear_right = cloudy_right = clear_frames = cloudy_frames = 0
+
+    for _ in range(frames):
+        cloudy = rng.random() < cloudy_fraction
+        rgb, injected = synthetic_frame(rng, width, height, n_streaks=0 if cloudy else streaks_per_frame, cloudy=cloudy)
+        raw = synthetic_raw(rgb)
+        grey_buffer = np.empty((height, width), 'float32')
+        grey_uint8 = np.empty((height, width), 'uint8')
+
+        start = time.perf_counter()
+        grey = timed(times, 'convert_to_grey', fo.convert_to_grey, rgb, grey_buffer)
+        is_clear, _ = timed(times, 'cloudy_or_clear', fo.cloudy_or_clear, grey, 1, tiles)
+        detected = []
+        if is_clear:
+            grey *= 255.0
+            np.copyto(grey_uint8, grey, casting='unsafe')
+            lines = timed(times, 'detect_lines', fo.detect_lines, grey_uint8)
+            if lines is not None:
+                detected = timed(times, 'group_segments', fo.group_segments, lines)
+                for streak in detected:
+                    timed(times, 'line_from_two_points', fo.line_from_two_points, *streak)
+        times.setdefault('end_to_end', []).append(time.perf_counter() - start)
+        # End-to-end covers everything process_image does between decoding
+        # and plate solving
+
+        timed(times, 'bayer_to_grey', fo.bayer_to_grey, raw, 2)
+        if is_clear:
+            timed(times, 'detect_lines_single', fo.detect_lines, grey_uint8, 1, 1)
+        # For comparison: 2x2 binning of Bayer data, and the streak search
+        # without the coarse to fine pyramid (only on frames classified
+        # clear, grey_uint8 is not filled otherwise)
+
+        if cloudy:
+            cloudy_frames += 1
+            cloudy_right += not is_clear
+        else:
+            clear_frames += 1
+            clear_right += is_clear
+            found, false, rows = match_streaks(injected, detected)
+            injected_total += len(injected)
+            found_total += found
+            false_total += false
+            rows_per_streak += [count for count in rows if count > 0]
+
+    stages = {}
+    for name, values in times.items():
+        stages[name] = {'count': len(values),
+                        'p50': float(np.percentile(values, 50)),
+                        'p95': float(np.percentile(values, 95)),
+                        'mean': float(np.mean(values))}
+    end_to_end = np.sum(times['end_to_end'])
+    return {'frames': frames,
+            'width': width,
+            'height': height,
+            'frames_per_second': frames/end_to_end,
+            'megapixels_per_second': frames*width*height/1e6/end_to_end,
+            'peak_memory': peak_memory(),
+            'clear_classified_clear': clear_right/float(max(clear_frames, 1)),
+            'cloudy_classified_cloudy': cloudy_right/float(max(cloudy_frames, 1)),
+            'injected_streaks': injected_total,
+            'recall': found_total/float(max(injected_total, 1)),
+            'false_detections': false_total,
+            'rows_per_streak': float(np.mean(rows_per_streak)) if rows_per_streak else 0.,
+            'max_rows_per_streak': max(rows_per_streak) if rows_per_streak else 0,
+            'stages': stages}
+
+
+
+def print_results(results):
+
+    """ Prints the results of run_benchmark as a table. """
+
+    print('%d frames of %dx%d: %.2f frames/s, %.1f MP/s end-to-end, peak memory %s MB' % (
+        results['frames'], results['width'], results['height'], results['frames_per_second'],
+        results['megapixels_per_second'], '%.0f' % results['peak_memory'] if results['peak_memory'] else 'n/a'))
+    print('cloud check: %.0f%% of clear frames clear, %.0f%% of cloudy frames cloudy' % (
+        100*results['clear_classified_clear'], 100*results['cloudy_classified_cloudy']))
+    print('streak recall: %.0f%% of %d injected streaks, %d false detections' % (
+        100*results['recall'], results['injected_streaks'], results['false_detections']))
+    print('rows per found streak: %.2f on average, %d at most' % (results['rows_per_streak'], results['max_rows_per_streak']))
+    print('    %-22s %6s %10s %10s %10s' % ('stage', 'count', 'p50 (s)', 'p95 (s)', 'mean (s)'))
+    for name, stage in results['stages'].items():
+        print('    %-22s %6d %10.4f %10.4f %10.4f' % (name, stage['count'], stage['p50'], stage['p95'], stage['mean']))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark Fire Opal image processing on synthetic frames')
+    parser.add_argument('--frames', type=int, default=10, help='Number of synthetic frames')
+    parser.add_argument('--width', type=int, default=6000, help='Frame width in pixels')
+    parser.add_argument('--height', type=int, default=4000, help='Frame height in pixels')
+    parser.add_argument('--cloudy', type=float, default=0.3, help='Fraction of cloudy frames')
+    parser.add_argument('--streaks', type=int, default=1, help='Streaks injected in each clear frame')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--json', help='Also write the results to this .json file')
+    opt = parser.parse_args()
+
+    results = run_benchmark(opt.frames, opt.width, opt.height, opt.cloudy, opt.streaks, opt.seed)
+    print_results(results)
+    if opt.json:
+        with open(opt.json, 'w') as jsonfile:
+            json.dump(results, jsonfile, indent=2)
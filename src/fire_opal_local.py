@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains an offline plate solver for Fire Opal. Instead of
+uploading crops to nova.astrometry.net, the stars found in a crop are matched
+against an index of a star catalogue on disk, in the same way as
+astrometry.net does it: quads of four stars are described by a hash code that
+does not change with position, rotation or scale, similar codes in the image
+and in the index are candidate matches, and a candidate is accepted if the
+other catalogue stars of the field then land on stars of the image.
+
+Structure:
+    - Defines functions for converting between RA/Dec, unit vectors and the
+    tangent plane (gnomonic projection)
+    - quad_codes computes the hash codes of quads of stars
+    - build_index selects the brightest catalogue stars around points spread
+    evenly over the sky, forms quads from them and saves stars, quads and
+    codes in a .npz file
+    - StarIndex loads an index and solves a list of star centroids, returning
+    a TAN WCS
+    - If run as a script, builds an index from a .csv catalogue
+
+Usage:
+    python fire_opal_local.py catalogue.csv index.npz --min-size 0.5 --max-size 4
+    catalogue.csv has columns named ra, dec (degrees) and mag, e.g. a subset of
+    Tycho-2 or Gaia down to the faintest stars visible in a crop. min-size and
+    max-size are the smallest and largest quads in degrees; a crop should be
+    a few times larger than the largest quad.
+
+Requirements:
+    numpy, scipy, astropy
+
+"""
+import argparse, itertools, math
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.wcs import WCS
+
+
+
+def unit_vectors(ra, dec):
+
+    """ Converts RA and Dec in degrees to unit vectors, shape (N, 3). """
+
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+
+
+def ra_dec(vectors):
+
+    """ Converts unit vectors to RA and Dec in degrees. """
+
+    vectors = np.asarray(vectors)
+    ra = np.degrees(np.arctan2(vectors[..., 1], vectors[..., 0])) % 360.
+    dec = np.degrees(np.arcsin(np.clip(vectors[..., 2], -1., 1.)))
+    return ra, dec
+
+
+
+def tangent_basis(centre):
+
+    """ Returns the unit vectors pointing east and north at centre. """
+
+    ra, dec = np.radians(ra_dec(centre))
+    east = np.array([-np.sin(ra), np.cos(ra), 0.])
+    north = np.array([-np.sin(dec)*np.cos(ra), -np.sin(dec)*np.sin(ra), np.cos(dec)])
+    return east, north
+
+
+
+def to_tangent_plane(vectors, centre):
+
+    """
+    Gnomonic projection of unit vectors onto the plane touching the sphere
+    at centre. Returns standard coordinates (xi east, eta north) in degrees,
+    shape (N, 2).
+
+    """
+    east, north = tangent_basis(centre)
+    along = vectors @ centre
+    return np.degrees(np.stack([vectors @ east/along, vectors @ north/along], axis=-1))
+
+
+
+def from_tangent_plane(xi_eta, centre):
+
+    """ Inverse of to_tangent_plane, returns unit vectors. """
+
+    east, north = tangent_basis(centre)
+    xi_eta = np.radians(np.atleast_2d(xi_eta))
+    vectors = centre + xi_eta[:, :1]*east + xi_eta[:, 1:]*north
+    return vectors/np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+
+def chord(degrees):
+
+    """ Straight line distance between two unit vectors degrees apart. """
+
+    return 2*math.sin(math.radians(degrees)/2.)
+
+
+
+PAIRS = np.array([(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)])
+OTHERS = np.array([(2, 3), (1, 3), (1, 2), (0, 3), (0, 2), (0, 1)])
+# The four stars of a quad split into two pairs in six ways
+
+def quad_codes(points, quads):
+
+    """
+    This function computes the hash codes of quads of stars. The two stars
+    furthest apart, A and B, define a frame in which A is at (0, 0) and B at
+    (1, 1). The code is the position of the other two stars, C and D, in this
+    frame, (xc, yc, xd, yd). A, B and C, D are ordered so that xc + xd <= 1
+    and xc <= xd, which makes the code unique.
+
+    Inputs: positions of stars in a plane, shape (N, 2), indices of the four
+    stars of each quad, shape (M, 4)
+    Outputs: codes, shape (M, 4), quads reordered as A, B, C, D, diameter of
+    each quad (distance from A to B)
+
+    """
+    z = points[:, 0] + 1j*points[:, 1]
+    zq = z[quads]
+    separation = np.abs(zq[:, PAIRS[:, 0]] - zq[:, PAIRS[:, 1]])
+    widest = np.argmax(separation, axis=1)
+    rows = np.arange(len(quads))[:, None]
+    ordered = np.concatenate([quads[rows, PAIRS[widest]], quads[rows, OTHERS[widest]]], axis=1)
+    # A and B are the widest pair, C and D the other two stars
+
+    zq = z[ordered]
+    diameter = np.abs(zq[:, 1] - zq[:, 0])
+    frame = (zq[:, 2:] - zq[:, :1])/(zq[:, 1:2] - zq[:, :1])*(1 + 1j)
+    # Similarity transform that takes A to 0 and B to 1+1j
+
+    swap_ab = frame.real.sum(axis=1) > 1
+    frame[swap_ab] = (1 + 1j) - frame[swap_ab]
+    ordered[swap_ab, :2] = ordered[swap_ab, 1::-1]
+    swap_cd = frame[:, 0].real > frame[:, 1].real
+    frame[swap_cd] = frame[swap_cd, ::-1]
+    ordered[swap_cd, 2:] = ordered[swap_cd, :1:-1]
+    # Swapping A and B takes (x, y) to (1 - x, 1 - y)
+
+    codes = np.stack([frame[:, 0].real, frame[:, 0].imag, frame[:, 1].real, frame[:, 1].imag], axis=1)
+    return codes, ordered, diameter
+
+
+
+def fibonacci_sphere(spacing):
+
+    """ Returns unit vectors spread evenly over the sky, about spacing degrees apart. """
+
+    n = int(4*math.pi/math.radians(spacing)**2) + 1
+    i = np.arange(n) + 0.5
+    dec = np.degrees(np.arcsin(1 - 2*i/n))
+    ra = np.degrees(math.pi*(1 + 5**0.5)*i) % 360.
+    return unit_vectors(ra, dec)
+
+
+
+def build_index(ra, dec, mag, filename, min_size, max_size, stars_per_field=10):
+
+    """
+    This function builds a star index for the local solver. Around points
+    spread evenly over the sky, max_size/2 degrees apart, it takes the
+    stars_per_field brightest stars within max_size degrees and forms every
+    quad of them between min_size and max_size degrees across. All stars of
+    the catalogue are kept for checking matches.
+
+    Inputs: RA, Dec (degrees) and magnitude of the catalogue stars, .npz file
+    to save the index to, smallest and largest quad in degrees, number of
+    stars used for quads around each point
+    Output: number of quads in the index
+
+    """
+    order = np.argsort(mag)
+    vectors = unit_vectors(np.asarray(ra)[order], np.asarray(dec)[order])
+    mag = np.asarray(mag, 'float32')[order]
+    # Brightest first, so the lowest indices near a point are its brightest stars
+    stars = cKDTree(vectors)
+    combinations = np.array(list(itertools.combinations(range(stars_per_field), 4)))
+
+    all_quads, all_codes = [], []
+    for centre in fibonacci_sphere(max_size/2.):
+        near = np.sort(stars.query_ball_point(centre, chord(max_size)))[:stars_per_field]
+        if len(near) < 4:
+            continue
+        points = to_tangent_plane(vectors[near], centre)
+        quads = combinations[(combinations < len(near)).all(axis=1)]
+        codes, ordered, diameter = quad_codes(points, quads)
+        keep = (diameter >= min_size) & (diameter <= max_size)
+        all_quads.append(near[ordered[keep]])
+        all_codes.append(codes[keep])
+    # Stars in A, B, C, D order, with codes measured in the tangent plane at
+    # the point, which is close enough to flat for quads of a few degrees
+
+    if not all_quads:
+        raise ValueError('no quads between %g and %g degrees in the catalogue' % (min_size, max_size))
+    quads = np.concatenate(all_quads)
+    codes = np.concatenate(all_codes)
+    _, first = np.unique(np.sort(quads, axis=1), axis=0, return_index=True)
+    first = np.sort(first)
+    # The same quad is found around neighbouring points
+
+    np.savez(filename, vectors=vectors, mag=mag, quads=quads[first].astype('int32'),
+             codes=codes[first].astype('float32'), min_size=min_size, max_size=max_size)
+    return len(first)
+
+
+
+class StarIndex:
+
+    """
+    A StarIndex holds the stars, quads and codes of an index made by
+    build_index, with k-d trees for finding similar codes and the stars in a
+    field. solve finds the WCS of a crop from the centroids of its stars.
+
+    """
+    def __init__(self, filename):
+        index = np.load(filename)
+        self.vectors = index['vectors']
+        self.quads = index['quads']
+        self.codes = index['codes']
+        self.min_size = float(index['min_size'])
+        self.max_size = float(index['max_size'])
+        self.stars = cKDTree(self.vectors)
+        self.code_tree = cKDTree(self.codes)
+
+    def __repr__(self):
+        return "StarIndex()"
+
+    def candidates(self, points, scale_lower=None, scale_upper=None, code_tol=0.01):
+
+        """
+        Returns (code distance, image quad, index quad) for every index quad
+        whose code is within code_tol of the code of a quad of the image, for
+        both parities of the image, closest first. Image quads are indices
+        into points in A, B, C, D order.
+
+        """
+        quads = np.array(list(itertools.combinations(range(len(points)), 4)))
+        found = []
+        for parity in (1., -1.):
+            codes, ordered, diameter = quad_codes(points*[1., parity], quads)
+            # A mirrored image has mirrored codes
+            keep = np.ones(len(quads), bool)
+            if scale_upper is not None:
+                keep &= diameter*scale_upper/3600. >= self.min_size
+            if scale_lower is not None:
+                keep &= diameter*scale_lower/3600. <= self.max_size
+            # Quads too small or too large to be in the index
+            distance, match = self.code_tree.query(codes[keep], k=3, distance_upper_bound=code_tol)
+            hit = np.isfinite(distance)
+            image_quad = np.broadcast_to(ordered[keep][:, None, :], (keep.sum(), 3, 4))
+            found.append((distance[hit], image_quad[hit], match[hit]))
+        distance = np.concatenate([f[0] for f in found])
+        order = np.argsort(distance)
+        return (distance[order], np.concatenate([f[1] for f in found])[order],
+                np.concatenate([f[2] for f in found])[order])
+
+    def fit(self, pixels, vectors, centre):
+
+        """
+        Least squares affine transform from pixels to the tangent plane at
+        centre: xi_eta = pixels @ matrix + offset.
+
+        """
+        design = np.column_stack([pixels, np.ones(len(pixels))])
+        solution = np.linalg.lstsq(design, to_tangent_plane(vectors, centre), rcond=None)[0]
+        return solution[:2], solution[2]
+
+    def verify(self, points, width, height, matrix, offset, centre, match_tol):
+
+        """
+        Projects the catalogue stars of the field into the image with a
+        candidate transform and returns the (image star, catalogue star)
+        pairs closer than match_tol pixels.
+
+        """
+        if abs(np.linalg.det(matrix)) < 1e-18:
+            return np.zeros(0, int), np.zeros(0, int)
+        middle = np.array([width/2., height/2.])
+        field_centre = from_tangent_plane(middle @ matrix + offset, centre)[0]
+        radius = np.hypot(width, height)/2.*math.sqrt(abs(np.linalg.det(matrix)))*1.2
+        near = np.array(self.stars.query_ball_point(field_centre, chord(radius)), int)
+        if len(near) == 0:
+            return np.zeros(0, int), np.zeros(0, int)
+        near = near[self.vectors[near] @ centre > 0.5]
+        pixels = (to_tangent_plane(self.vectors[near], centre) - offset) @ np.linalg.inv(matrix)
+        inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+        distance, nearest = cKDTree(points).query(pixels[inside], distance_upper_bound=match_tol)
+        hit = np.isfinite(distance)
+        image_stars, first = np.unique(nearest[hit], return_index=True)
+        return image_stars, near[inside][hit][first]
+        # Each image star is matched to one catalogue star at most
+
+    def solve(self, x, y, width, height, scale_lower=None, scale_upper=None, field_stars=20,
+              code_tol=0.01, match_tol=3.0, min_matches=8, max_tries=500):
+
+        """
+        This function plate solves a crop from the centroids of its stars.
+
+        Inputs: x and y centroids in crop pixels (0-based, brightest first),
+        width and height of the crop, range of the pixel scale in arcsec per
+        crop pixel if known, number of brightest stars used for quads,
+        largest difference between matching codes, largest distance in
+        pixels between an image star and its catalogue star, number of
+        matched stars needed to accept a solution, number of candidate
+        matches to try
+        Outputs: astropy WCS (TAN projection, CRPIX at the centre of the crop)
+        and the number of matched stars, or (None, 0) if no solution is found
+
+        """
+        points = np.column_stack([x, y]).astype(float)
+        if len(points) < 4:
+            return None, 0
+        distance, image_quads, index_quads = self.candidates(points[:field_stars], scale_lower, scale_upper, code_tol)
+
+        for image_quad, index_quad in zip(image_quads[:max_tries], index_quads[:max_tries]):
+            quad_vectors = self.vectors[self.quads[index_quad]]
+            centre = quad_vectors.sum(axis=0)
+            centre /= np.linalg.norm(centre)
+            matrix, offset = self.fit(points[image_quad], quad_vectors, centre)
+            scale = math.sqrt(abs(np.linalg.det(matrix)))*3600.
+            if (scale_lower is not None and scale < scale_lower) or (scale_upper is not None and scale > scale_upper):
+                continue
+            image_stars, catalogue_stars = self.verify(points, width, height, matrix, offset, centre, match_tol)
+            if len(image_stars) < min_matches:
+                continue
+            # A wrong match puts catalogue stars where there are no stars
+
+            middle = np.array([width/2., height/2.])
+            centre = from_tangent_plane(middle @ matrix + offset, centre)[0]
+            for _ in range(2):
+                matrix, offset = self.fit(points[image_stars], self.vectors[catalogue_stars], centre)
+                image_stars, catalogue_stars = self.verify(points, width, height, matrix, offset, centre, match_tol)
+            # Refits with all matched stars about the centre of the crop
+
+            w = WCS(naxis=2)
+            w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+            w.wcs.crval = np.array(ra_dec(centre), float)
+            w.wcs.crpix = -offset @ np.linalg.inv(matrix) + 1
+            w.wcs.cd = matrix.T
+            # The pixel where the tangent plane touches the sky, in FITS
+            # (1-based) pixel coordinates
+            return w, len(image_stars)
+        return None, 0
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a star index for the Fire Opal local plate solver')
+    parser.add_argument('catalogue', help='.csv file with ra, dec and mag columns')
+    parser.add_argument('index', help='.npz file to write the index to')
+    parser.add_argument('--min-size', type=float, required=True, help='Smallest quad in degrees')
+    parser.add_argument('--max-size', type=float, required=True, help='Largest quad in degrees')
+    parser.add_argument('--stars-per-field', type=int, default=10, help='Brightest stars used for quads around each point')
+    parser.add_argument('--mag-limit', type=float, help='Ignore stars fainter than this')
+    opt = parser.parse_args()
+
+    catalogue = np.genfromtxt(opt.catalogue, delimiter=',', names=True)
+    if opt.mag_limit is not None:
+        catalogue = catalogue[catalogue['mag'] <= opt.mag_limit]
+    n_quads = build_index(catalogue['ra'], catalogue['dec'], catalogue['mag'], opt.index,
+                          opt.min_size, opt.max_size, opt.stars_per_field)
+    print('%d stars, %d quads written to %s' % (len(catalogue), n_quads, opt.index))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the timing and memory instrumentation used by the Fire
+Opal process flow.
+
+Structure:
+    - FrameMetrics records the wall time and peak memory of each processing
+    stage of one image
+    - MetricsLog writes the records of all images and plate solved crops to
+    a .jsonl file (one JSON object per line) and summarises a run
+
+Requirements:
+    json, time, os, numpy
+
+"""
+import json, os, time
+from contextlib import contextmanager
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+    # Not available on Windows, peak memory is then not reported
+
+
+
+def reset_peak_memory():
+
+    """
+    Resets the peak resident memory of the current process, so that the
+    next call of peak_memory measures a single image. Only possible on Linux,
+    elsewhere the peak since the start of the process is reported.
+
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        pass
+
+
+
+def peak_memory():
+
+    """
+    Returns the peak resident memory of the current process in MB, or None
+    if it cannot be measured on this platform.
+
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/2.0**10
+                    # Peak since the last reset_peak_memory, in kB
+    except (IOError, OSError):
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == 'Darwin':
+        return peak/2.0**20
+        # Bytes on macOS, kilobytes on Linux
+    return peak/2.0**10
+
+
+
+class FrameMetrics:
+
+    """
+    A FrameMetrics object records the wall time and peak memory of each
+    processing stage of one image. Time spent in a stage that runs several
+    times (e.g. once per streak) is added up. tile_scores holds the scores of
+    the cloud check, so that they are reported by the parent process rather
+    than printed from a worker.
+
+    """
+    def __init__(self):
+        self.start(None)
+
+    def __repr__(self):
+        return "FrameMetrics()"
+
+    def start(self, file):
+        self.file = file
+        self.stages = {}
+        self.memory = {}
+        self.tile_scores = None
+        self.started = time.perf_counter()
+        reset_peak_memory()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+            memory = peak_memory()
+            if memory is not None:
+                self.memory[name] = memory
+
+    def record(self):
+
+        """ Returns the measurements of the image as a dictionary. """
+
+        return {'file': self.file,
+                'pid': os.getpid(),
+                'total': time.perf_counter() - self.started,
+                'stages': self.stages,
+                'peak_memory': peak_memory(),
+                'stage_peak_memory': self.memory,
+                'tile_scores': self.tile_scores}
+
+
+
+class MetricsLog:
+
+    """
+    A MetricsLog collects the FrameMetrics records of a run. Each record is
+    appended to a .jsonl file as it arrives, and summary returns the 50th and
+    95th percentile time of each stage and the number of frames per second.
+
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.metrics = open(filename, 'a+') if filename else None
+        self.started = time.perf_counter()
+        self.times = {}
+        self.frames = 0
+        self.peak = 0.
+
+    def __repr__(self):
+        return "MetricsLog()"
+
+    def add(self, record):
+        if self.metrics is not None:
+            self.metrics.write(json.dumps(record) + '\n')
+            self.metrics.flush()
+        self.frames += 1
+        self.times.setdefault('total', []).append(record['total'])
+        for name, seconds in record['stages'].items():
+            self.times.setdefault(name, []).append(seconds)
+        if record['peak_memory'] is not None:
+            self.peak = max(self.peak, record['peak_memory'])
+
+    def add_crop(self, file, number, stages):
+
+        """
+        Adds the stage times of plate solving a crop, which runs after the
+        image has been processed. They are written as a separate record
+        with the file name and the number of the crop.
+
+        """
+        if self.metrics is not None:
+            self.metrics.write(json.dumps({'file': file, 'crop': number, 'stages': stages}) + '\n')
+            self.metrics.flush()
+        for name, seconds in stages.items():
+            self.times.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        stages = {}
+        for name, times in self.times.items():
+            stages[name] = {'count': len(times),
+                            'p50': float(np.percentile(times, 50)),
+                            'p95': float(np.percentile(times, 95)),
+                            'total': float(np.sum(times))}
+        return {'frames': self.frames,
+                'seconds': elapsed,
+                'frames_per_second': self.frames/elapsed if elapsed > 0 else 0.,
+                'peak_memory': self.peak,
+                'stages': stages}
+
+    def close(self):
+        if self.metrics is not None:
+            self.metrics.close()
+
+
+
+def print_summary(summary):
+
+    """ Prints a run summary returned by MetricsLog.summary as a table. """
+
+    print('%d frames in %.1f s, %.2f frames/s, peak memory %.0f MB' % (summary['frames'], summary['seconds'], summary['frames_per_second'], summary['peak_memory']))
+    print('    %-10s %8s %10s %10s %10s' % ('stage', 'count', 'p50 (s)', 'p95 (s)', 'total (s)'))
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['total']):
+        print('    %-10s %8d %10.4f %10.4f %10.1f' % (name, stage['count'], stage['p50'], stage['p95'], stage['total']))
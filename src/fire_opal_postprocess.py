@@ -6,20 +6,30 @@ Created on Thu Aug 15 10:55:17 2019
 
 Structure:
     - Defines classes, functions
-    - Initializes lists
-    - Reads in data from txt file
-    - Processing
-     - Saves output in txt file
+    - read_streaks reads the streak data txt file one line at a time, or the
+    streak table (see fire_opal_table.py) one block of records at a time
+    - group_streaks follows each satellite through images with consecutive
+    serial numbers, matching the streaks of an image to those of the image
+    before by their direction and position. table_groups does the same on
+    the columns of a streak table
+    - resolve_direction and orbital_points find the direction of a satellite
+    trail and its (ra, dec, time) points
+    - write_iod saves the points of each satellite in a txt file in IOD format
+    - main runs all of the above on streaks_table (or streaks_data if there
+    is no table) when the file is run as a script. The functions work on
+    iterables, so that they can also be used from other scripts and on files
+    of any size.
 
 Requirements:
-    fire_opal_settings, groupby.itertools, numpy
+    fire_opal_settings, fire_opal_table, numpy
     
 """
 
 from fire_opal_settings import *
+import math
 import numpy as np
-from itertools import groupby
-import more_itertools as mit
+from collections import OrderedDict
+from fire_opal_table import STREAK_DTYPE, STREAK_FIELDS, StreakTable, is_table, sync_table
 
 
 
@@ -155,73 +165,378 @@ def deg2HMS(ra, dec):
   
     return str(RA+DEC)
 
-list_of_streaky_images = []
-# Initialize a list to contain the StreakyImage objects created from recorded
-# data
-list_of_satellites = []
-# Initialize a list to contain distinct but unidentified satellites
-
-""" Processing starts here """
-""" Data extraction """
-data = open(streaks_data, 'r')
-# Opens txt file where data from Fire Opal image processing is stored
-extracted_data = data.readlines()
-# Creates list of lines in the txt file as list of strings
-remove_duplicates = list(dict.fromkeys(extracted_data))
-# Converts data into a dictionary and then back into a list to remove duplicates
-for line_of_data in remove_duplicates:
+def parse_streak(line_of_data):
+
+    """
+    Converts one line of streak data into a StreakyImage object.
+
+    Input: line of the streak data txt file
+    Output: StreakyImage
+
+    """
     get_data = line_of_data.split(',') # List of data points in a line
-    serialno = int(get_data[0][28:32])
-    one_streak = Streak(get_data[0], get_data[1], float(get_data[2]), float(get_data[3]), float(get_data[4]), float(get_data[5]), float(get_data[6]), float(get_data[7]), float(get_data[8]), float(get_data[9]), get_data[10], get_data[11], float(get_data[12]), float(get_data[13]))
+    return streaky_image(get_data[0], get_data[1], float(get_data[2]), float(get_data[3]), float(get_data[4]), float(get_data[5]), float(get_data[6]), float(get_data[7]), float(get_data[8]), float(get_data[9]), get_data[10], get_data[11], float(get_data[12]), float(get_data[13]))
+
+
+
+def streaky_image(filename, timestamp, *values):
+
+    """
+    Creates the StreakyImage of one streak from the 14 values of a line of
+    streak data.
+
+    """
+    serialno = int(filename[28:32])
+    one_streak = Streak(filename, timestamp, *values)
     # Assigns extracted data to a Streak data object. See fire_opal_settings.py
     # for note about floor_scale, which is multiplying the slope of the streak.
-    streak_image = StreakyImage(get_data[0], get_data[1], one_streak, serialno)
+    return StreakyImage(filename, timestamp, one_streak, serialno)
     # Assigns Streak object to a Streaky Image object
-    list_of_streaky_images.append(streak_image)
-    # Creates list of Streaky Image objects
-
-""" Identification of satellite trail over multiple images """
-#slope_list = []
-#for streakyimage in list_of_streaky_images:
-#    slope_list.append(streakyimage.streak.slope)
-## Creates a list of slopes of all streaks
-
-#groups = []  
-#for key, group in groupby(slope_list, np.floor):
-#    groups.append(list(group))
-## Creates list of groups of slope values, e.g. [[2.1, 2.5, 2.3], [45.6, 45.8, 45.3]]
-## Streaks with the same slope are assumed to be the same streak
-
-serialno_list = []
-for streakyimage in list_of_streaky_images:
-    serialno_list.append(streakyimage.serialno)
-# Creates a list of image serial numbers from all images
-unique_satellites = []
-for group in mit.consecutive_groups(serialno_list):
-    unique_satellites.append(list(group))
-# Creates a list of lists - each sublist is a grouping of consecutive serial
-# numbers, e.g. [[196, 197, 198], [943, 944], [1112, 1113, 1114, 1115], ...]    
-satellites_with_enough_data = []
-for sat in unique_satellites:
-    if len(sat) < 2:
-        continue
-    else:
-        satellites_with_enough_data.append(sat)
-# We need at least two images of the same streak for the orbit determination.
-# This code discards satellites for which we have only one image.
-        
 
-""" Determination of direction of satellite trail """
 
-for j in range(0,len(satellites_with_enough_data)): # Selects one group at a time
-    images_with_same_streak = [] 
-    for streakyimage in list_of_streaky_images:        
-        if streakyimage.serialno in satellites_with_enough_data[j]:
-            images_with_same_streak.append(streakyimage)
-    # Creates a list of StreakyImage objects that contain the same streak (i.e.
-    # streaks have the same slope).StreakyImage objects are appended in 
-    # CONSECUTIVE order, which allows the next block of code to function.
+
+def unique_lines(lines, window=None):
+
+    """
+    Yields the lines that have not been seen before, in order. Duplicate
+    lines appear when a run is restarted. If window is given, only the last
+    window distinct lines are remembered, so that memory use does not grow
+    with the number of lines.
+
+    """
+    seen = OrderedDict()
+    for line in lines:
+        if line in seen:
+            continue
+        seen[line] = None
+        if window is not None and len(seen) > window:
+            seen.popitem(last=False)
+        yield line
+
+
+
+def read_streaks(filename=streaks_data, window=duplicate_window):
+
+    """
+    Generator that reads the streak data txt file one line at a time and
+    yields a StreakyImage for every distinct line. Streak tables are passed
+    on to read_table.
+
+    Inputs: name of the streak data txt file or streak table, number of
+    distinct lines remembered for removing duplicates (None for all)
+    Output: StreakyImage objects, in the order of the file
+
+    """
+    if is_table(filename):
+        for streaky in read_table(filename, window):
+            yield streaky
+        return
+    with open(filename, 'r') as data:
+        for line_of_data in unique_lines(data, window):
+            yield parse_streak(line_of_data)
+
+
+
+def read_table(filename=streaks_table, window=duplicate_window, block=100000):
+
+    """
+    Generator that reads a streak table (see fire_opal_table.py) and yields a
+    StreakyImage for every distinct record. The table is memory mapped and
+    converted block records at a time, so no text is parsed and only one
+    block is held as Python objects.
+
+    Inputs: name of the streak table, number of distinct records remembered
+    for removing duplicates (None for all), records converted at a time
+    Output: StreakyImage objects, in the order of the table
+
+    """
+    records = StreakTable(filename).read()
+    for row in unique_lines(table_rows(records, block=block), window):
+        yield streaky_image(*row)
+
+
+
+def table_rows(records, index=None, block=100000):
+
+    """
+    Generator that yields the records of a streak table (all, or those in
+    index) as tuples of the 14 values of a line of streak data. A whole
+    column of a block of records is converted to Python values at once.
+
+    """
+    if index is None:
+        index = np.arange(len(records))
+    for start in range(0, len(index), block):
+        records_in_block = records[index[start:start + block]]
+        columns = [records_in_block[field].astype(str).tolist() if records.dtype[field].kind == 'S'
+                   else records_in_block[field].tolist() for field in STREAK_FIELDS]
+        for row in zip(*columns):
+            yield row
+
+
+
+def serial_numbers(records):
+
+    """ Returns the serial numbers of the images of a streak table (characters 28-31 of the filename). """
+
+    digits = np.dtype({'names': ['serialno'], 'formats': [('u1', 4)], 'offsets': [28], 'itemsize': STREAK_DTYPE.itemsize})
+    serialno = records.view(digits)['serialno'].astype(int) - ord('0')
+    if np.any((serialno < 0) | (serialno > 9)):
+        raise ValueError('file names without a serial number in characters 28-31')
+    return serialno @ np.array([1000, 100, 10, 1])
+    # Reads the four characters straight from the memory map, without
+    # copying the file names
+
+
+
+def duplicate_records(records, window=duplicate_window):
+
+    """
+    Returns a boolean array that is True for the records that repeat an
+    earlier record within the previous window records (any earlier record
+    if window is None). Only records that share the RA and Dec of their
+    first endpoint with another record can be duplicates; these few are
+    sorted by all of their bytes, so that identical records are next to
+    each other in the order of the table.
+
+    """
+    ra, dec = np.array(records['ra1']), np.array(records['dec1'])
+    order = np.lexsort((dec, ra))
+    tie = (ra[order[1:]] == ra[order[:-1]]) & (dec[order[1:]] == dec[order[:-1]])
+    candidates = order[np.concatenate([[False], tie]) | np.concatenate([tie, [False]])]
+    # The sorts are stable, so records with the same RA and Dec stay in the
+    # order of the table
+    
+    whole = records.view('V%d' % STREAK_DTYPE.itemsize)
+    candidates = candidates[np.argsort(whole[candidates], kind='stable')]
+    earlier, later = candidates[:-1], candidates[1:]
+    same = whole[earlier] == whole[later]
+    if window is not None:
+        same &= later - earlier <= window
+    duplicate = np.zeros(len(records), bool)
+    duplicate[later[same]] = True
+    return duplicate
+
+
+
+def table_groups(filename=streaks_table, window=duplicate_window, min_images=2, block=10000):
+
+    """
+    Generator that yields the same groups as group_streaks(read_table(...)),
+    but finds them on the memory mapped columns of the streak table: the
+    duplicates are removed and the runs of images with consecutive serial
+    numbers are found with numpy, and StreakyImage objects are only made
+    for the records of runs of at least min_images images. A satellite is
+    never followed across a gap in the serial numbers, so group_streaks is
+    run on each of these runs separately.
+
+    Inputs: name of the streak table, number of records searched for
+    duplicates (None for all), least number of images in a group, records
+    converted at a time
+    Output: lists of StreakyImage objects of the same satellite
+
+    """
+    records = StreakTable(filename).read()
+    if len(records) == 0:
+        return
+    keep = np.flatnonzero(~duplicate_records(records, window))
+    step = np.diff(serial_numbers(records)[keep])
+    breaks = np.flatnonzero((step != 0) & (step != 1)) + 1
+    lengths = np.diff(np.concatenate([[0], breaks, [len(keep)]]))
+    images = np.add.reduceat(np.concatenate([[1], step != 0]), np.concatenate([[0], breaks]))
+    # A new run starts wherever the serial number is neither the same as
+    # (another streak of the same image) nor one more than the one before
     
+    long_enough = images >= min_images
+    rows = table_rows(records, keep[np.repeat(long_enough, lengths)], block)
+    for length in lengths[long_enough]:
+        for group in group_streaks([streaky_image(*next(rows)) for _ in range(length)], min_images):
+            yield group
+
+
+
+def image_frames(streaky_images):
+
+    """
+    Generator that yields the StreakyImage objects of one image at a time,
+    i.e. the consecutive objects with the same serial number.
+
+    """
+    frame = []
+    for streakyimage in streaky_images:
+        if frame and streakyimage.serialno != frame[-1].serialno:
+            yield frame
+            frame = []
+        frame.append(streakyimage)
+    if frame:
+        yield frame
+
+
+
+def line_offset(first, second):
+
+    """
+    Compares the positions of two Streak objects in full resolution pixels.
+
+    Inputs: two Streak objects
+    Outputs: angle between the streaks in degrees, distance of the middle of
+    the second streak from the line of the first, distance between the
+    middles of the streaks
+
+    """
+    length = math.hypot(first.x2 - first.x1, first.y2 - first.y1) or 1.
+    ux, uy = (first.x2 - first.x1)/length, (first.y2 - first.y1)/length
+    length = math.hypot(second.x2 - second.x1, second.y2 - second.y1) or 1.
+    vx, vy = (second.x2 - second.x1)/length, (second.y2 - second.y1)/length
+    angle = math.degrees(math.acos(min(1., abs(ux*vx + uy*vy))))
+    mx = (second.x1 + second.x2 - first.x1 - first.x2)/2.
+    my = (second.y1 + second.y2 - first.y1 - first.y2)/2.
+    return angle, abs(mx*uy - my*ux), math.hypot(mx, my)
+
+
+
+def join_streaks(first, second):
+
+    """
+    Returns a StreakyImage with one streak from the outermost endpoints of
+    the streaks of two StreakyImage objects of the same image, in the
+    direction of the first streak.
+
+    """
+    a, b = first.streak, second.streak
+    ux, uy = a.x2 - a.x1, a.y2 - a.y1
+    ends = [(a.x1, a.y1, a.ra1, a.dec1), (a.x2, a.y2, a.ra2, a.dec2),
+            (b.x1, b.y1, b.ra1, b.dec1), (b.x2, b.y2, b.ra2, b.dec2)]
+    ends.sort(key=lambda end: end[0]*ux + end[1]*uy)
+    (x1, y1, ra1, dec1), (x2, y2, ra2, dec2) = ends[0], ends[-1]
+    slope = (y2 - y1)/(x2 - x1) if x2 != x1 else (y2 - y1)/1.
+    # Same as line_from_two_points in fire_opal_v2.py for a vertical streak
+    return streaky_image(first.filename, first.timestamp, ra1, dec1, x1, y1, ra2, dec2, x2, y2,
+                         a.endpointa_time, a.endpointb_time, slope, y2 - slope*x2)
+
+
+
+def merge_pieces(frame, angle_tol=streak_angle_tol, offset_tol=streak_offset_tol):
+
+    """
+    Joins the streaks of one image that lie on the same line (the angle and
+    offset tolerances of the streak detection) into one streak. Detection
+    splits a streak with a long faint part into several rows; two
+    satellites on the same line in one image are much rarer.
+
+    Input: list of StreakyImage objects of one image
+    Output: list of StreakyImage objects, one per streak
+
+    """
+    merged = []
+    for streakyimage in frame:
+        for i, other in enumerate(merged):
+            angle, offset, _ = line_offset(other.streak, streakyimage.streak)
+            if angle <= angle_tol and offset <= offset_tol:
+                merged[i] = join_streaks(other, streakyimage)
+                break
+        else:
+            merged.append(streakyimage)
+    return merged
+
+
+
+def continues(track, streakyimage, angle_tol=track_angle_tol, offset_tol=track_offset_tol):
+
+    """
+    Checks if the streak of an image continues the trail of a satellite
+    seen in the image before. The streak has to lie along the line of the
+    last streak of the trail and, once the trail has two streaks, be ahead
+    of the last one in the direction the satellite moves.
+
+    Inputs: list of StreakyImage objects of one satellite, StreakyImage of
+    the next image
+    Output: offset from the line of the trail in pixels (smaller is a
+    better match), or None if the streak is not part of the trail
+
+    """
+    last, streak = track[-1].streak, streakyimage.streak
+    angle, offset, distance = line_offset(last, streak)
+    if angle > angle_tol or offset > offset_tol + distance*math.sin(math.radians(angle_tol)):
+        return None
+    if len(track) > 1:
+        before = track[-2].streak
+        moved = ((last.x1 + last.x2 - before.x1 - before.x2)*(streak.x1 + streak.x2 - last.x1 - last.x2)
+                 + (last.y1 + last.y2 - before.y1 - before.y2)*(streak.y1 + streak.y2 - last.y1 - last.y2))
+        if moved <= 0:
+            return None
+    return offset
+
+
+
+def group_streaks(streaky_images, min_images=2):
+
+    """
+    Follows each satellite through images with consecutive serial numbers,
+    e.g. images 196, 197 and 198. An image can have several streaks: the
+    pieces of one streak are joined first (see merge_pieces), then each
+    streak continues the trail of the image before that it fits best (see
+    continues), or starts a new trail. We need at least two images of the
+    same streak for the orbit determination, so trails of fewer than
+    min_images images are discarded.
+
+    Input: iterable of StreakyImage objects, in the order they were taken
+    Output: lists of StreakyImage objects of the same satellite, one per
+    image, in the order the trails end
+
+    """
+    tracks = []
+    for frame in image_frames(streaky_images):
+        frame = merge_pieces(frame)
+        if tracks and tracks[0][-1].serialno != frame[0].serialno - 1:
+            for track in tracks:
+                if len(track) >= min_images:
+                    yield track
+            tracks = []
+        # No trail continues across a gap in the serial numbers
+        
+        matches = []
+        for i, track in enumerate(tracks):
+            for j, streakyimage in enumerate(frame):
+                offset = continues(track, streakyimage)
+                if offset is not None:
+                    matches.append((offset, i, j))
+        matches.sort()
+        track_of = {}
+        for offset, i, j in matches:
+            if i not in track_of.values() and j not in track_of:
+                track_of[j] = i
+        # Best matches first, each trail and each streak is used once
+        
+        for i, track in enumerate(tracks):
+            if i not in track_of.values() and len(track) >= min_images:
+                yield track
+        # Trails that do not continue in this image have ended
+        
+        for j, i in track_of.items():
+            tracks[i].append(frame[j])
+        tracks = [track for i, track in enumerate(tracks) if i in track_of.values()] \
+            + [[streakyimage] for j, streakyimage in enumerate(frame) if j not in track_of]
+    for track in tracks:
+        if len(track) >= min_images:
+            yield track
+    # Only the trails of the last image are held in memory
+
+
+
+def resolve_direction(images_with_same_streak):
+
+    """
+    Compares the first image of a group to the second image and checks which
+    direction the streak endpoints have moved. If the trail is moving "in
+    reverse" (away from the origin), swaps the times associated with each
+    endpoint in all images of the group.
+
+    Input: list of StreakyImage objects of the same satellite, in
+    CONSECUTIVE order
+    Output: the same list
+
+    """
     if images_with_same_streak[0].streak.x1 == images_with_same_streak[1].streak.x1: # If streak is vertical, x-endpoints are identical (fringe case)
         if images_with_same_streak[0].streak.y1 > images_with_same_streak[1].streak.y1: # Find direction of trail based on movement of y-endpoint
             for i in range(0, len(images_with_same_streak)):
@@ -235,45 +550,103 @@ for j in range(0,len(satellites_with_enough_data)): # Selects one group at a tim
             images_with_same_streak[i].streak.endpointb_time = images_with_same_streak[i].streak.timestamp
     else:
         pass
+    return images_with_same_streak
 
-    # This section of code compares the first image in the list to the second
-    # image and checks which direction the streak endpoints have moved. If the
-    # trail is moving "in reverse" (away from the origin), the code swaps the
-    # times associated with each endpoint.
-    
+
+
+def orbital_points(images_with_same_streak):
+
+    """
+    Returns the list of OrbitalPoints (both endpoints of every streak)
+    belonging to one satellite.
+
+    """
     points_for_one_satellite = []
     for image in images_with_same_streak:         
         point1 = OrbitalPoint(image.filename, image.streak.ra1, image.streak.dec1, image.streak.endpointa_time)
         point2 = OrbitalPoint(image.filename, image.streak.ra2, image.streak.dec2, image.streak.endpointb_time)
         points_for_one_satellite.append(point1)
         points_for_one_satellite.append(point2)
-        # Creates OrbitalPoints objects and appends to a list of points 
-        # belonging to the same satellite
-    list_of_satellites.append(points_for_one_satellite)
-    # Master list of unidentified satellites
-
-""" Formatting of data as IOD and saving in txt file """
-count = 0       
-for sat in list_of_satellites:
-    count += 1
-    txtname = 'satellite%s.txt' % count
-    # Gives unidentified satellites consecutively numbered filenames
-    with open(txtpath + txtname, 'a+') as txtFile:
-        for point in sat:
-            prefix = '99999 99 999999 1234 E ' 
-            # 9's are fillers, 1234 is the station code
-            datetag = (point.filename[4:8] + point.filename[9:11] + point.filename[12:14] + str(point.time).replace(':','')).replace(' ','')
-            # Creates date and time from filename and time
-            millisecs = '000'
-            timeunc = ' 28 15 '
-            # Time uncertainty, filler
-            ra_dec = deg2HMS(point.ra, point.dec)
-            # RA and DEC converted into IOD format
-            suffix = ' 99 S\n' 
-            # Positional uncertainty, filler
-            file_line = prefix + datetag + millisecs + timeunc + ra_dec + suffix
-            txtFile.write(file_line)
-        txtFile.close()
-# Creates a separate txt file for each satellite. Txt file contains the
-# (ra, dec, time) points for the satellite in IOD format.
-        
+    return points_for_one_satellite
+
+
+
+def satellites(streaky_images):
+
+    """
+    Generator that yields the list of OrbitalPoints of each unidentified
+    satellite found in an iterable of StreakyImage objects.
+
+    """
+    for images_with_same_streak in group_streaks(streaky_images):
+        yield orbital_points(resolve_direction(images_with_same_streak))
+
+
+
+def iod_line(point):
+
+    """ Formats an OrbitalPoint as a line in IOD format. """
+
+    prefix = '99999 99 999999 1234 E ' 
+    # 9's are fillers, 1234 is the station code
+    datetag = (point.filename[4:8] + point.filename[9:11] + point.filename[12:14] + str(point.time).replace(':','')).replace(' ','')
+    # Creates date and time from filename and time
+    millisecs = '000'
+    timeunc = ' 28 15 '
+    # Time uncertainty, filler
+    ra_dec = deg2HMS(point.ra, point.dec)
+    # RA and DEC converted into IOD format
+    suffix = ' 99 S\n' 
+    # Positional uncertainty, filler
+    return prefix + datetag + millisecs + timeunc + ra_dec + suffix
+
+
+
+def write_iod(list_of_satellites, directory=txtpath):
+
+    """
+    Creates a separate txt file for each satellite, with consecutively
+    numbered filenames (satellite1.txt, satellite2.txt, ...). Txt file
+    contains the (ra, dec, time) points for the satellite in IOD format.
+
+    Inputs: iterable of lists of OrbitalPoints, one list per satellite,
+    directory to save the txt files in
+    Output: number of satellites written
+
+    """
+    count = 0       
+    for sat in list_of_satellites:
+        count += 1
+        txtname = 'satellite%s.txt' % count
+        with open(directory + txtname, 'a+') as txtFile:
+            for point in sat:
+                txtFile.write(iod_line(point))
+    return count
+
+
+
+def main(filename=None, directory=txtpath, window=duplicate_window):
+
+    """
+    Post-processes the streak data into IOD files of satellites. Reads
+    streaks_table (after copying the lines of streaks_data it does not have
+    yet, see sync_table) or, without a table, streaks_data. window is the
+    number of lines searched for duplicates.
+
+    """
+    if filename is None:
+        if streaks_table:
+            sync_table(streaks_data, streaks_table)
+            filename = streaks_table
+        else:
+            filename = streaks_data
+    if is_table(filename):
+        groups = table_groups(filename, window)
+    else:
+        groups = group_streaks(read_streaks(filename, window))
+    return write_iod((orbital_points(resolve_direction(group)) for group in groups), directory)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -16,21 +16,45 @@ txtpath = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/txt/'
 streaks_data = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/streaks_data.txt'
 # .txt file that stores data relating to satellite streaks extracted from
 # image batch processing
+streaks_table = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/streaks_data.streaks'
+# Binary copy of streaks_data (see fire_opal_table.py) that post-processing
+# reads without parsing text, None to write the .txt file only. Lines of
+# streaks_data that are not in the table yet are copied when it is opened.
 processingrecord = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/processed_images.txt'
 # .txt file that records filenames of images as they are processed, this 
 # avoids re-processing of images if there is an error or the program crashes
+metricsfile = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/metrics.jsonl'
+# .jsonl file that records the time and peak memory of each processing stage
+# for every image (one JSON object per line). None switches this off.
+metricssummary = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/metrics_summary.jsonl'
+# .jsonl file that records a summary of each run (percentiles of stage times,
+# frames per second). None switches this off.
 datadirectory = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/test_set/'
 # Directory containing images to be processed
-pythonpath = 'C:/WPy64-3720/python-3.7.2.amd64/python.exe'
-# Location of Python distribution (needed for command line in Windows)
-clientpath = 'C:/WPy64-3720/python-3.7.2.amd64/Lib/nova_client.py'
-# Location of Astrometry.net API client script
 detectionpath = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/detected_streaks/'
 uploads_from = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/detected_streaks/'
 # Folder containing small images with detected streaks to be sent to
 # Astrometry.net
 wcs_goes_to = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/detected_streaks/wcs/'
 # Folder into which WCS files are saved when sent back from Astrometry.net
+# (if archive_wcs is True)
+
+
+""" Parallel Processing """
+
+n_workers = 1
+# Number of worker processes used by process_list. Set to the number of cores
+# available on the node, e.g. 32. 1 processes images in the main process.
+max_in_flight = None
+# Maximum number of images submitted to the worker pool at any time. None
+# uses twice the number of workers.
+solves_in_flight = 16
+# Maximum number of crops waiting for astrometry.net at the same time
+max_pending_solves = None
+# Maximum number of crops queued for plate solving, and of images whose
+# streak data waits for a solution before it can be written. New images
+# wait while more are pending, so a slow astrometry.net does not fill the
+# memory with crops. None uses four times solves_in_flight.
 
 
 """ Astrometry.net API """
@@ -38,8 +62,33 @@ wcs_goes_to = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/detected_streaks/wc
 # An API key is needed to access astrometry.net. The API key is linked
 # to a specific user account.
 apikey = ''
+nova_url = 'http://nova.astrometry.net/api/'
+# Astrometry.net API address. Each worker process logs in once and reuses
+# the session for every streak.
+nova_concurrency = 8
+# Maximum number of requests sent to astrometry.net at the same time by one
+# process. Connections are kept open and reused.
+nova_timeout = 60
+# Seconds to wait for a reply from astrometry.net before giving up
+nova_poll_min = 2
+nova_poll_max = 30
+# Shortest and longest interval in seconds between status checks of a
+# submission. The interval grows while a job is still running.
+nova_solve_timeout = 1800
+# Seconds after which a submission that has not been solved counts as
+# failed. None waits forever.
+
+
 
 
+""" RAW Conversion """
+
+decode_mode = 'full'
+# 'full' demosaics at full resolution, 'half' demosaics at half resolution,
+# 'bin2' bins 2x2 Bayer blocks straight to grey without demosaicing, with
+# the white balance, brightening and gamma curve of the full conversion, so
+# the same thresholds apply. Streak endpoints are always recorded in full
+# resolution pixel coordinates.
 
 
 """ Cloudy or Clear?:
@@ -59,6 +108,28 @@ row2 = int(2500)
 col1 = int(2000)
 col2 = int(2500)
 # Row and column values for subimage
+cl_tiles = [(row1, row2, col1, col2)]
+# Subimages sampled by the cloud check, as (row1, row2, col1, col2). Use
+# several tiles to handle partial cloud, e.g.
+# [(1000, 1500, 1500, 2000), (1000, 1500, 4000, 4500),
+#  (2500, 3000, 1500, 2000), (2500, 3000, 4000, 4500)]
+cl_min_clear_tiles = 1
+# Number of tiles that must contain stars for the image to count as clear
+
+# Triage on a small copy of the image before the full RAW conversion #
+
+triage_mode = 'none'
+# 'thumbnail' uses the JPEG preview embedded in the NEF file, 'raw' averages
+# a sparse grid of Bayer pixels, 'none' always runs the full RAW conversion.
+# Images that pass the triage are checked again at full resolution, images
+# that fail it are recorded as cloudy without a full resolution check.
+triage_reduce = 4
+# Reduction factor of the triage image (1, 2, 4 or 8)
+triage_background_thresh = cl_background_thresh
+triage_lower_thresh = cl_lower_thresh
+# Background and star thresholds of the triage. The camera's JPEG preview is
+# tone mapped differently from raw.postprocess(), so check these on previews
+# of known clear and cloudy images before turning the triage on
 
 # Variation 2: Algorithm using histogram bins (cloudy_or_clear_alt) #
 # Not being used at the moment
@@ -78,12 +149,148 @@ definitely_an_edge = 180 # Above this gradient value, pixel is definitely an edg
 # Hough line transform 
 line_votes = 100 # How many votes for something to count as line (e.g. length of line)
 
+# Grouping of lines into streaks (distances in full resolution pixels)
+streak_angle_tol = 2.0
+# Lines whose angles differ by more than this many degrees are different streaks
+streak_offset_tol = 10.0
+# Maximum distance of the midpoint of a line from another line of the same streak
+streak_gap_tol = 200.0
+# Maximum gap along the streak between lines of the same streak. Faint
+# parts of synthetic streaks leave gaps of 110-140 pixels between lines;
+# longer breaks are joined in post-processing (see merge_pieces)
+streak_min_length = 100.0
+# Streaks shorter than this are discarded
+max_streaks = 5
+# At most this many streaks (the longest) are cropped and solved per image
+max_segments = 2000
+# If HoughLinesP finds more lines than this (e.g. in a noisy image), only the
+# longest are grouped into streaks
+
+# Coarse to fine search
+pyramid_factor = 4
+# Lines are first searched for in a copy of the image that is this many
+# times smaller, then confirmed at full resolution. 1 searches the whole
+# image at full resolution.
+pyramid_edge_scale = 0.5
+# Canny thresholds are multiplied by this factor in the smaller copy, where
+# thin streaks have lower contrast
+pyramid_roi_margin = 32
+# Margin in pixels around each candidate line searched at full resolution
+
 # Section of image that contains streak
 box_length = 600
 # Distance in pixels from centre of box to edge, e.g. 250 would give a 500x500 box
 
+""" Plate Solving """
+
+plate_solver = 'nova'
+# 'nova' plate solves crops with nova.astrometry.net. 'local' solves them
+# offline from the stars in the crop and the star catalogue index below,
+# made with fire_opal_local.py
+local_index = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/star_index.npz'
+pixel_scale_lower = None
+pixel_scale_upper = None
+# Range of the pixel scale of the camera in arcsec per full resolution
+# pixel, if known. Makes local solving faster.
+local_field_stars = 20
+# Brightest stars of a crop used to form quads
+local_code_tol = 0.01
+# Largest difference between the codes of matching quads
+local_match_tol = 3.0
+# Largest distance in pixels between a star and its catalogue star
+local_min_matches = 8
+# Matched stars needed to accept a solution
+local_max_tries = 500
+# Candidate matches tried before giving up
+
+reuse_wcs = False
+# Check each crop against the latest solution of the same camera first and
+# only plate solve it if the stars do not match. For fixed or tracking
+# mounts, where the solution hardly changes between exposures.
+reuse_max_age = 300
+# Seconds after which a solution is no longer reused
+reuse_tol = 1.0
+# Median distance in pixels between stars and their predicted positions
+# up to which a solution is reused as it is (or refitted, if further)
+reuse_search_radius = 20.0
+# Largest shift in pixels of the stars between two exposures
+reuse_match_tol = 2.0
+# Largest distance in pixels between a star and its predicted position
+# after correcting for the shift
+reuse_min_matches = 6
+# Matched stars needed to reuse a solution
+reuse_max_stars = 2000
+# Stars remembered for each camera
+
+wcs_source = 'calibration'
+# 'calibration' makes the WCS of a solved crop from the calibration of the
+# astrometry.net job (centre, pixel scale, orientation, parity) in memory.
+# 'fits' downloads and reads the WCS file of the job, which also has the
+# SIP distortion terms.
+archive_wcs = False
+# Save the WCS of every solved crop in wcs_goes_to
+
+solve_cache = 'C:/Users/inner_000/Desktop/Research/Fire_Opal/solve_cache/'
+# Folder in which the results of astrometry.net are kept, so that crops
+# solved before (e.g. when a run is restarted) are not uploaded again.
+# None to switch the cache off.
+solve_cache_size = 100
+# Largest size of the cache in MB, the least recently used results are
+# deleted first
+
+save_crops = True
+# Save the .png crops around streaks in detectionpath. They are uploaded
+# from memory either way.
+crop_bits = 8
+# 8 or 16 bit .png crops. 16 bits keep more of the faint stars but make
+# larger files.
+crop_png_compression = None
+# zlib compression level of the .png crops, 0 (none) to 9 (slowest), or
+# None for the OpenCV default (1)
+crop_png_strategy = 'huffman'
+# zlib strategy of the .png crops: 'huffman', 'rle', 'filtered' or
+# 'default'. Noisy night sky crops hardly repeat, so 'huffman' is both the
+# fastest and makes the smallest files.
+downsample_factor = None
+# If set (e.g. 2), astrometry.net shrinks the crop by this factor before
+# finding stars in it. Solutions are still in crop pixels.
+
+solve_mode = 'image'
+# 'image' uploads the .png crop around each streak to astrometry.net.
+# 'sources' finds the brightest stars in the crop and uploads only their
+# positions and the size of the crop.
+source_count = 50
+# Number of stars uploaded in 'sources' mode
+source_sigma = 5.0
+# Stars must be this many times the background noise above the background
+streak_mask_width = 5
+# Pixels on either side of the streak that are ignored when finding stars
+
+use_solve_hints = True
+# Solve crops with the position and pixel scale of the latest solution from
+# the same station and camera, and blind if that fails
+hint_max_age = 600
+# Seconds between two images for the solution of one to be used for the other
+hint_scale_err = 10
+# Allowed difference from the previous pixel scale in percent
+hint_margin = 1.0
+# Degrees added to the search radius around the previous solution
+
 """ Post-Processing """
 
+duplicate_window = 10000
+# Number of distinct lines of streak data remembered when removing duplicate
+# lines (written again when a run is restarted, so they are close to the
+# original). Memory use of post-processing is bounded by this, None
+# remembers every line.
+track_angle_tol = 5.0
+# Streaks in consecutive images belong to the same satellite only if their
+# directions differ by less than this many degrees
+track_offset_tol = 50.0
+# and if the middle of the later streak is within this many pixels of the
+# line of the earlier one, plus track_angle_tol of the distance between them
+# (trails curve across a wide field). Streaks of one satellite 15 seconds
+# apart are about 2700 pixels apart and 1-12 pixels off each other's line.
 floor_scale = 100
 # The slope is multiplied by this factor. The floor function used in grouping
 # rounds to the nearest integer. Since slopes in test data can have values
@@ -0,0 +1,712 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the plate solving stage of the Fire Opal process flow.
+
+Structure:
+    - StreakCrop describes the section of an image cropped around a streak
+    - SolveHints remembers the latest calibration of each camera, so that
+    the next crops of the same camera are solved with position and scale
+    hints instead of blind
+    - SolveCache keeps the results of plate solves on disk, so that a crop
+    that was solved before is not uploaded again
+    - Solver is the interface of the plate solving backends. NovaSolver
+    solves crops with nova.astrometry.net, LocalSolver offline with a star
+    catalogue index (see fire_opal_local.py). ReuseSolver puts the last
+    solution of each camera in front of another Solver
+    - calibration_wcs makes the WCS of a crop from the calibration of an
+    astrometry.net job, without downloading the WCS file
+    - solve_crop plate solves a crop with the backend chosen in plate_solver
+    - PlateSolveQueue keeps many crops in flight at once, so that image
+    processing does not wait for astrometry.net
+
+Requirements:
+    Astrometry.net API client
+    fire_opal_settings.py
+    fire_opal_local.py (for the local backend)
+    astropy, threading, datetime, hashlib, json, concurrent.futures
+
+"""
+from fire_opal_settings import *
+import hashlib, http.client, io, json, math, os, threading, time
+import datetime as dt
+import nova_client
+from astropy.wcs import WCS
+from astropy.io import fits
+from fire_opal_local import StarIndex
+import numpy as np
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+
+class SolveFailure(Exception):
+    pass
+    # Raised by a Solver when a crop cannot be plate solved
+
+
+
+class SolveUnavailable(SolveFailure):
+    pass
+    # Raised instead when the solve failed because of a network or server
+    # error, so the crop may be solved if it is tried again later
+
+
+
+class StreakCrop:
+
+    """
+    A StreakCrop is the section of an image around one detected streak,
+    saved as a .png image for plate solving. Attributes are the original
+    file name, the number of the streak in the image, the .png and WCS file
+    names, the endpoints of the streak in decoded image pixels, the scale
+    of the full resolution image relative to the decoded image, the corner
+    (x_lo, y_lo) and size of the crop in decoded image pixels, if star
+    positions are needed for solving, the brightest stars in the crop and
+    the encoded .png image.
+
+    """
+    def __init__(self, file, number, filename, uploadpath, wcsfile, x1, y1, x2, y2, scale, x_lo, y_lo, width, height, sources=None, data=None):
+        self.file = file
+        self.number = number
+        self.filename = filename
+        self.uploadpath = uploadpath
+        self.wcsfile = wcsfile
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.scale = scale
+        self.x_lo = x_lo
+        self.y_lo = y_lo
+        self.width = width
+        self.height = height
+        self.sources = sources
+        # (x, y) lists of star centroids in crop pixels, or None
+        self.data = data
+        # Bytes of the .png image, or None to upload the file at uploadpath
+
+    def __repr__(self):
+        return "StreakCrop()"
+
+    def __str__(self):
+        return str(self.__class__) + ": " + str(self.__dict__)
+
+
+
+nova = None
+nova_closed = False
+nova_lock = threading.Lock()
+# nova.astrometry.net client of this process, logged in on first use and
+# shared by all plate solving threads
+
+def nova_session(expired=None):
+
+    """
+    Returns the logged in nova.astrometry.net client of this process. The
+    client logs in on the first call. If expired is given (the session of a
+    request that failed, e.g. because the session has expired) and the
+    client still has that session, the same client logs in again, so
+    threads that fail at the same time log in only once. Raises
+    SolveUnavailable after close_session.
+
+    """
+    global nova
+    with nova_lock:
+        if nova_closed:
+            raise SolveUnavailable('plate solving has been stopped')
+        if nova is None:
+            client = nova_client.Client(nova_url, nova_concurrency, nova_timeout)
+            client.poller = nova_client.Poller(client, nova_poll_min, nova_poll_max, timeout=nova_solve_timeout)
+            # One polling thread tracks the jobs of all plate solving threads
+            client.login(apikey)
+            nova = client
+        elif expired is not None and nova.session == expired:
+            nova.login(apikey)
+        return nova
+
+
+
+def open_session():
+
+    """ Allows nova_session to log in again after close_session. """
+
+    global nova_closed
+    with nova_lock:
+        nova_closed = False
+
+
+
+def close_session():
+
+    """
+    Closes the nova.astrometry.net client of this process. Threads still
+    solving a crop fail at their next wait for a job or request for a
+    session, instead of waiting for astrometry.net.
+
+    """
+    global nova, nova_closed
+    with nova_lock:
+        client, nova = nova, None
+        nova_closed = True
+    if client is not None:
+        client.close()
+
+
+
+class SolveHints:
+
+    """
+    SolveHints keeps the latest astrometry.net calibration of each camera,
+    identified by the station and camera in the file name (e.g. '005' and
+    'A' in 005_2018-12-24_170529_A_DSC_0135.NEF). A crop from the same camera
+    taken within max_age seconds is searched for only around that
+    calibration: the search radius covers the old field, the distance
+    between the two crops and the drift of the sky in the time between them.
+
+    """
+    def __init__(self, max_age=hint_max_age, scale_err=hint_scale_err, margin=hint_margin):
+        self.max_age = max_age
+        self.scale_err = scale_err
+        self.margin = margin
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "SolveHints()"
+
+    @staticmethod
+    def camera(crop):
+
+        """
+        Returns the (station, camera) key and the time the image was taken,
+        or (None, None) if the file name does not follow the usual pattern.
+
+        """
+        parts = crop.file.split('_')
+        try:
+            taken = dt.datetime.strptime(parts[1] + parts[2], '%Y-%m-%d%H%M%S')
+            return (parts[0], parts[3]), taken
+        except (IndexError, ValueError):
+            return None, None
+
+    def get(self, crop):
+
+        """ Returns upload arguments for the crop, empty if there is no hint. """
+
+        key, taken = self.camera(crop)
+        with self.lock:
+            entry = self.latest.get(key)
+        if key is None or entry is None:
+            return {}
+        calibration, x, y, then = entry
+        age = abs((taken - then).total_seconds())
+        if age > self.max_age:
+            return {}
+
+        moved = math.hypot((crop.x1 + crop.x2)/2. - x, (crop.y1 + crop.y2)/2. - y)*calibration['pixscale']/3600.
+        drift = age*15.04/3600.
+        # Distance between the centres of the two crops, and rotation of the
+        # sky in the time between them (15 arcsec per second at most), in
+        # degrees
+        return {'center_ra': calibration['ra'],
+                'center_dec': calibration['dec'],
+                'radius': calibration['radius'] + moved + drift + self.margin,
+                'scale_units': 'arcsecperpix',
+                'scale_type': 'ev',
+                'scale_est': calibration['pixscale'],
+                'scale_err': self.scale_err}
+
+    def put(self, crop, calibration):
+        key, taken = self.camera(crop)
+        if key is not None:
+            with self.lock:
+                self.latest[key] = (calibration, (crop.x1 + crop.x2)/2., (crop.y1 + crop.y2)/2., taken)
+            # Centre of the crop in decoded image pixels
+
+
+
+class SolveCache:
+
+    """
+    A SolveCache keeps the results of plate solves (job id, calibration and
+    WCS header) on disk, one small .json file per upload, named after a hash
+    of the uploaded bytes and the upload arguments. When a run is restarted,
+    or a crop is solved again, the result is read from the cache instead of
+    uploading the same crop again. When the files take up more than
+    max_bytes, the least recently used are deleted.
+
+    """
+    def __init__(self, directory=solve_cache, max_bytes=solve_cache_size*2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                self.sizes[name] = os.path.getsize(os.path.join(directory, name))
+
+    def __repr__(self):
+        return "SolveCache()"
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @staticmethod
+    def key(content, arguments):
+
+        """ Returns the cache key of an upload: content (bytes) and upload arguments (dict). """
+
+        digest = hashlib.sha256(content)
+        digest.update(json.dumps(arguments, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.directory, key + '.json')
+        try:
+            with open(path) as cached:
+                record = json.load(cached)
+            os.utime(path, None)
+            # Marks the result as recently used
+            return record
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, record):
+        name = key + '.json'
+        path = os.path.join(self.directory, name)
+        data = json.dumps(record)
+        temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        # Unique to this thread and process, e.g. when array jobs share the
+        # cache directory
+        with open(temporary, 'w') as cached:
+            cached.write(data)
+        os.replace(temporary, path)
+        # A crash while writing does not leave a broken result behind
+
+        with self.lock:
+            self.sizes[name] = len(data)
+            total = sum(self.sizes.values())
+            if total <= self.max_bytes:
+                return
+            def last_used(name):
+                try:
+                    return os.path.getmtime(os.path.join(self.directory, name))
+                except OSError:
+                    return 0.
+            for old in sorted(self.sizes, key=last_used):
+                if total <= 0.9*self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+                total -= self.sizes.pop(old)
+            # Deletes down to 90% of the limit, so that not every new result
+            # has to delete an old one
+
+
+
+def calibration_wcs(calibration, width, height):
+
+    """
+    This function makes a TAN WCS from the calibration of an astrometry.net
+    job: the RA and Dec of the centre of the image, the pixel scale, the
+    orientation (degrees East of North) and the parity. The CD matrix is the
+    one for which astrometry.net's tan_get_orientation returns this
+    orientation, with parity the sign of its determinant. The WCS has no SIP
+    distortion terms, which wcs_pix2world does not use anyway.
+
+    Inputs: calibration dictionary, width and height of the crop in pixels
+    Output: astropy WCS object
+
+    """
+    scale = calibration['pixscale']/3600.
+    orientation = np.radians(calibration['orientation'])
+    parity = 1. if calibration['parity'] >= 0 else -1.
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [calibration['ra'], calibration['dec']]
+    w.wcs.crpix = [(width + 1)/2., (height + 1)/2.]
+    # The calibration gives the sky position of the centre of the image, in
+    # FITS (1-based) pixel coordinates
+    w.wcs.cd = scale*np.array([[parity*np.cos(orientation), np.sin(orientation)],
+                               [-parity*np.sin(orientation), np.cos(orientation)]])
+    return w
+
+
+
+class Solver:
+
+    """
+    A Solver plate solves StreakCrops. Backends implement solve, which
+    returns an astropy WCS of the crop and a dictionary of the wall times of
+    its stages, or raises SolveFailure if the crop cannot be solved. One
+    Solver is shared by all plate solving threads of a process.
+
+    """
+    def __repr__(self):
+        return "Solver()"
+
+    def solve(self, crop):
+        raise NotImplementedError
+
+
+
+class NovaSolver(Solver):
+
+    """
+    A NovaSolver uploads a crop to nova.astrometry.net using the client of
+    this process, waits for the solution and reads the WCS calibration.
+    With wcs_source = 'calibration' the WCS is made from the calibration of
+    the job, otherwise the WCS file of the job is downloaded and read. If
+    archive_wcs is True, the WCS is also saved in the directory specified in
+    wcs_goes_to.
+
+    In 'sources' solve mode, only the star centroids and the size of the
+    crop are submitted instead of the .png image. This avoids
+    uploading the image and the source extraction on the server. Otherwise
+    the .png image is uploaded from memory if the crop has it, and
+    astrometry.net is asked to downsample it by downsample_factor.
+
+    If use_solve_hints is True, crops are solved with the position and scale
+    of a recent calibration from the same camera. If the hinted solve fails,
+    the crop is solved again blind.
+
+    If solve_cache is set, results are kept in a SolveCache and a crop that
+    has been solved before is not uploaded again.
+
+    """
+    def __init__(self):
+        self.hints = SolveHints() if use_solve_hints else None
+        self.cache = SolveCache() if solve_cache else None
+        # Calibrations and results shared by all plate solving threads of
+        # this process
+
+    def __repr__(self):
+        return "NovaSolver()"
+
+    def solve(self, crop):
+        try:
+            return self.solve_nova(crop)
+        except nova_client.JobFailure as error:
+            raise SolveFailure(str(error))
+        except (nova_client.RequestError, nova_client.MalformedResponse, http.client.HTTPException, OSError) as error:
+            raise SolveUnavailable('%s: %s' % (type(error).__name__, error))
+            # Includes connection errors and timeouts (OSError)
+
+    def job_arguments(self):
+
+        """
+        Returns the arguments of astrometry.net jobs that come from the
+        settings (hints are added per crop).
+
+        """
+        if solve_mode != 'sources' and downsample_factor is not None:
+            return {'downsample_factor': downsample_factor}
+        return {}
+
+    def upload_content(self, crop):
+
+        """ Returns the bytes that identify the upload of a crop. """
+
+        if solve_mode == 'sources':
+            return json.dumps([crop.sources, crop.width, crop.height]).encode('utf-8')
+        if crop.data is not None:
+            return crop.data
+        with open(crop.uploadpath, 'rb') as upload:
+            return upload.read()
+
+    def solve_nova(self, crop):
+        def submit(client, **kwargs):
+            kwargs.update(self.job_arguments())
+            if solve_mode == 'sources':
+                x, y = crop.sources
+                return client.solve_xy([xi + 1 for xi in x], [yi + 1 for yi in y], crop.width, crop.height, **kwargs)
+                # astrometry.net expects FITS pixel coordinates, which start at 1
+            return client.solve(crop.uploadpath, data=crop.data, **kwargs)
+
+        def solve(**kwargs):
+            client = nova_session()
+            session = client.session
+            try:
+                return submit(client, **kwargs)
+            except nova_client.RequestError:
+                return submit(nova_session(expired=session), **kwargs)
+                # Logs in again in case the session has expired
+
+        start = time.perf_counter()
+        key = record = None
+        if self.cache is not None:
+            key = self.cache.key(self.upload_content(crop), dict(self.job_arguments(), nova_url=nova_url, solve_mode=solve_mode))
+            record = self.cache.get(key)
+        cached = dict(record) if record is not None else None
+        # Everything that changes the job is part of the key: the uploaded
+        # content, the server (job ids are only valid on the server that
+        # made them), the solve mode and the job arguments of the settings.
+        # Hints are not, they only make the search faster.
+
+        if record is None:
+            hint = self.hints.get(crop) if self.hints is not None else {}
+            try:
+                job_id = solve(**hint)
+            except nova_client.JobFailure:
+                if not hint:
+                    raise
+                job_id = solve()
+                # The camera may have moved, try again without hints
+            record = {'job': job_id, 'calibration': None, 'wcs_header': None}
+        if record['calibration'] is None and (self.hints is not None or self.cache is not None or wcs_source == 'calibration'):
+            record['calibration'] = nova_session().calibration(record['job'])
+        if self.hints is not None:
+            self.hints.put(crop, record['calibration'])
+        solved = time.perf_counter()
+
+        if wcs_source == 'calibration':
+            w = calibration_wcs(record['calibration'], crop.width, crop.height)
+            header = w.to_header()
+        else:
+            if record['wcs_header'] is None:
+                wcs_data = nova_session().wcs_file(record['job'])
+                hdu = fits.open(io.BytesIO(wcs_data))
+                record['wcs_header'] = hdu[0].header.tostring()
+            header = fits.Header.fromstring(record['wcs_header'])
+            w = WCS(header)
+            # Reads the wcs file from memory and extracts calibration
+            # information from header
+            # Note: Throws a warning that the axes of the WCS file are 0
+            # when the expected number of axes is 2. This can be ignored,
+            # the program will continue running.
+        if archive_wcs:
+            fits.PrimaryHDU(header=header).writeto(crop.wcsfile, overwrite=True)
+        if key is not None and record != cached:
+            self.cache.put(key, record)
+        return w, {'cache' if cached is not None else 'solve': solved - start,
+                   'wcs' if wcs_source == 'calibration' else 'fits': time.perf_counter() - solved}
+
+
+
+class LocalSolver(Solver):
+
+    """
+    A LocalSolver plate solves a crop offline from the centroids of its
+    stars, by matching them against the star catalogue index local_index.
+    If archive_wcs is True, the WCS is also saved in the directory
+    specified in wcs_goes_to.
+
+    """
+    def __init__(self, index=local_index):
+        self.index = StarIndex(index)
+
+    def __repr__(self):
+        return "LocalSolver()"
+
+    def solve(self, crop):
+        if crop.sources is None:
+            raise SolveFailure('no stars found in %s' % crop.filename)
+        lower = pixel_scale_lower*crop.scale if pixel_scale_lower is not None else None
+        upper = pixel_scale_upper*crop.scale if pixel_scale_upper is not None else None
+        # Crop pixels are crop.scale full resolution pixels across
+
+        start = time.perf_counter()
+        x, y = crop.sources
+        w, matches = self.index.solve(x, y, crop.width, crop.height, lower, upper,
+                                      local_field_stars, local_code_tol, local_match_tol,
+                                      local_min_matches, local_max_tries)
+        if w is None:
+            raise SolveFailure('no match for %s in %s' % (crop.filename, local_index))
+        solved = time.perf_counter()
+
+        if archive_wcs:
+            fits.PrimaryHDU(header=w.to_header()).writeto(crop.wcsfile, overwrite=True)
+        return w, {'solve': solved - start, 'wcs': time.perf_counter() - solved}
+
+
+
+class ReuseSolver(Solver):
+
+    """
+    A ReuseSolver remembers the latest plate solution of each camera as a
+    WCS of the whole decoded image, together with the RA and Dec of the
+    stars of the solved crops. A new crop from the same camera is first
+    checked against this solution: the remembered stars are projected into
+    the crop and matched to its stars. If they land within reuse_tol pixels
+    the solution is used as it is; if they are further off but still match,
+    e.g. because the sky has drifted across a fixed camera, the shift and
+    rotation of the stars is fitted and applied to the solution. Only crops
+    that do not match are passed on to the backend Solver.
+
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.pointings = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "ReuseSolver()"
+
+    def solve(self, crop):
+        key, taken = SolveHints.camera(crop)
+        with self.lock:
+            pointing = self.pointings.get(key)
+        start = time.perf_counter()
+        if pointing is not None and crop.sources is not None and abs((taken - pointing[3]).total_seconds()) <= reuse_max_age:
+            w = self.check(crop, pointing)
+            if w is not None:
+                self.remember(crop, w, key, taken)
+                return w, {'reuse': time.perf_counter() - start}
+
+        w, times = self.backend.solve(crop)
+        if key is not None:
+            self.remember(crop, w, key, taken)
+        return w, times
+
+    def check(self, crop, pointing):
+
+        """
+        Returns the WCS of the crop from the remembered solution, refitted if
+        needed, or None if the crop does not match it.
+
+        """
+        frame_wcs, ra, dec, _ = pointing
+        w = frame_wcs.deepcopy()
+        w.wcs.crpix = w.wcs.crpix - [crop.x_lo, crop.y_lo]
+        # The same solution with the corner of the crop as its origin
+        px, py = w.wcs_world2pix(ra, dec, 0)
+        inside = (px > -reuse_search_radius) & (px < crop.width + reuse_search_radius) \
+            & (py > -reuse_search_radius) & (py < crop.height + reuse_search_radius)
+        predicted = np.column_stack([px, py])[inside]
+        points = np.column_stack(crop.sources)
+        if len(predicted) < reuse_min_matches or len(points) < reuse_min_matches:
+            return None
+
+        stars = cKDTree(points)
+        distance, nearest = stars.query(predicted, distance_upper_bound=reuse_search_radius)
+        hit = np.isfinite(distance)
+        if hit.sum() < reuse_min_matches:
+            return None
+        shift = np.median(points[nearest[hit]] - predicted[hit], axis=0)
+        distance, nearest = stars.query(predicted + shift, distance_upper_bound=reuse_match_tol)
+        hit = np.isfinite(distance)
+        if hit.sum() < reuse_min_matches:
+            return None
+        # A common shift first, then each star on its own, so that a drift
+        # of several pixels does not mix up neighbouring stars
+
+        measured = points[nearest[hit], 0] + 1j*points[nearest[hit], 1]
+        expected = predicted[hit, 0] + 1j*predicted[hit, 1]
+        if np.median(np.abs(measured - expected)) <= reuse_tol:
+            return w
+
+        design = np.column_stack([expected, np.ones(len(expected))])
+        a, b = np.linalg.lstsq(design, measured, rcond=None)[0]
+        if np.median(np.abs(measured - (a*expected + b))) > reuse_tol:
+            return None
+        # measured = a*expected + b is a shift, rotation and change of scale
+
+        move = np.array([[a.real, -a.imag], [a.imag, a.real]])
+        w.wcs.crpix = move @ (w.wcs.crpix - 1) + [b.real, b.imag] + 1
+        if w.wcs.has_cd():
+            w.wcs.cd = w.wcs.cd @ np.linalg.inv(move)
+        else:
+            w.wcs.pc = w.wcs.get_pc() @ np.linalg.inv(move)
+        # The pixel that was at p is now at move @ p + b
+        return w
+
+    def remember(self, crop, w, key, taken):
+        frame_wcs = w.deepcopy()
+        frame_wcs.wcs.crpix = frame_wcs.wcs.crpix + [crop.x_lo, crop.y_lo]
+        # Moves the origin from the corner of the crop to the corner of the
+        # decoded image
+        ra = dec = np.zeros(0)
+        if crop.sources is not None and len(crop.sources[0]):
+            ra, dec = w.wcs_pix2world(crop.sources[0], crop.sources[1], 0)
+        with self.lock:
+            pointing = self.pointings.get(key)
+            if pointing is not None and abs((taken - pointing[3]).total_seconds()) <= reuse_max_age:
+                ra = np.concatenate([pointing[1], ra])[-reuse_max_stars:]
+                dec = np.concatenate([pointing[2], dec])[-reuse_max_stars:]
+            # Stars of earlier crops of the same pointing are kept, so that
+            # crops anywhere in the image can be checked
+            self.pointings[key] = (frame_wcs, ra, dec, taken)
+
+
+
+backend = None
+backend_lock = threading.Lock()
+
+def get_solver():
+
+    """ Returns the Solver of this process chosen in plate_solver, created on first use. """
+
+    global backend
+    with backend_lock:
+        if backend is None:
+            backends = {'nova': NovaSolver, 'local': LocalSolver}
+            backend = backends[plate_solver]()
+            if reuse_wcs:
+                backend = ReuseSolver(backend)
+        return backend
+
+
+
+def solve_crop(crop):
+
+    """
+    This function plate solves a crop with the Solver of this process.
+
+    Input: StreakCrop
+    Outputs: astropy WCS object, dictionary of wall times of the 'solve'
+    stage and of reading the WCS ('fits' or 'wcs')
+    Raises SolveFailure if the crop cannot be solved.
+
+    """
+    return get_solver().solve(crop)
+
+
+
+class PlateSolveQueue:
+
+    """
+    A PlateSolveQueue plate solves crops in a pool of threads, so that up to
+    in_flight crops are waiting for astrometry.net at the same time while
+    images continue to be processed. Crops are added with submit, and
+    completed returns the crops whose solutions have arrived. close(wait=
+    False) drops the crops that have not started and closes the client, so
+    that the crops being solved fail instead of running to the timeout.
+
+    """
+    def __init__(self, solve=solve_crop, in_flight=solves_in_flight):
+        self.solve = solve
+        self.pool = ThreadPoolExecutor(max_workers=in_flight)
+        self.pending = {}
+        open_session()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __repr__(self):
+        return "PlateSolveQueue()"
+
+    def submit(self, crop):
+        future = self.pool.submit(self.solve, crop)
+        self.pending[future] = crop
+
+    def completed(self, block=False):
+
+        """
+        Returns a list of (crop, future) pairs for the crops that have been
+        solved (or have failed) since the last call. The result of each
+        future is the output of the solve function. If block is True, waits
+        until at least one crop has finished.
+
+        """
+        if not self.pending:
+            return []
+        done, _ = wait(list(self.pending), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        return [(self.pending.pop(future), future) for future in done]
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+        close_session()
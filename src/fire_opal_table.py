@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the binary streak table of Fire Opal, a columnar copy of
+the streak data txt file that can be read without parsing any text.
+
+Each streak is one record of a NumPy structured array with the 14 fields of
+a line of streak data. The table file is a short header followed by the
+records, so new streaks are appended at the end and the whole table is read
+with a memory map, in milliseconds and without creating Python objects for
+every streak. The number of records follows from the size of the file, so
+an interrupted append loses at most the streak being written.
+
+Structure:
+    - STREAK_DTYPE describes one streak
+    - parse_row and format_row convert between a line of streak data and a
+    record
+    - StreakTable appends to and memory maps a table file, holding a lock
+    on the file so that several processes (e.g. the tasks of a SLURM array
+    job) can append to the same table
+    - text_to_table and table_to_text convert between the txt file and the
+    table, sync_table copies the lines of the txt file that the table does
+    not have yet
+    - If run as a script, converts a file in either direction
+
+Usage:
+    python fire_opal_table.py streaks_data.txt streaks_data.streaks
+    python fire_opal_table.py streaks_data.streaks streaks_data.txt
+
+Requirements:
+    numpy
+
+"""
+import argparse, itertools, json, os
+from contextlib import contextmanager
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    # Not available on Windows, only one process should then write a table
+
+
+STREAK_FIELDS = ['filename', 'timestamp', 'ra1', 'dec1', 'x1', 'y1', 'ra2', 'dec2', 'x2', 'y2',
+                 'endpointa_time', 'endpointb_time', 'slope', 'intercept']
+STREAK_DTYPE = np.dtype([('filename', 'S64'), ('timestamp', 'S6'),
+                         ('ra1', 'f8'), ('dec1', 'f8'), ('x1', 'f8'), ('y1', 'f8'),
+                         ('ra2', 'f8'), ('dec2', 'f8'), ('x2', 'f8'), ('y2', 'f8'),
+                         ('endpointa_time', 'S8'), ('endpointb_time', 'S8'),
+                         ('slope', 'f8'), ('intercept', 'f8')])
+# Same fields and order as a line of streak data (see streak_row in
+# fire_opal_v2.py). Text fields are ASCII, endpoint times are HH:MM:SS.
+
+MAGIC = b'FOSTREAK'
+HEADER_SIZE = 512
+
+
+
+def parse_row(line_of_data):
+
+    """ Converts a line of streak data into a tuple for STREAK_DTYPE. """
+
+    get_data = line_of_data.rstrip('\r\n').split(',')
+    return tuple(value.encode('ascii') if STREAK_DTYPE[field].kind == 'S' else float(value)
+                 for field, value in zip(STREAK_FIELDS, get_data))
+
+
+
+def format_row(record):
+
+    """ Converts a record of a streak table back into a line of streak data. """
+
+    return ','.join(record[field].decode('ascii') if STREAK_DTYPE[field].kind == 'S' else repr(float(record[field]))
+                    for field in STREAK_FIELDS) + '\n'
+    # repr gives the shortest text that reads back as the same float, as
+    # printed in the txt file
+
+
+
+class StreakTable:
+
+    """
+    A StreakTable is a table file of streaks. A new file gets a header with
+    the layout of the records; an existing file is checked against
+    STREAK_DTYPE. append adds records at the end of the file and read
+    returns all records as a read-only memory map.
+
+    Writes happen while holding an exclusive lock on the file (see locked),
+    which other processes wait for, so records of different processes are
+    never interleaved or written over each other.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.handle = None
+        with open(filename, 'ab'):
+            pass
+        # Creates the file without truncating one that another process has
+        # just created
+        
+        with self.locked():
+            self.handle.seek(0)
+            header = self.handle.read(HEADER_SIZE)
+            if not header:
+                layout = json.dumps(STREAK_DTYPE.descr).encode('ascii')
+                header = MAGIC + layout
+                if len(header) > HEADER_SIZE:
+                    raise ValueError('streak table header too long')
+                self.handle.write(header.ljust(HEADER_SIZE, b' '))
+                return
+        if not header.startswith(MAGIC):
+            raise ValueError('%s is not a streak table' % filename)
+        descr = [tuple(field) for field in json.loads(header[len(MAGIC):].decode('ascii'))]
+        if np.dtype(descr) != STREAK_DTYPE:
+            raise ValueError('%s has a different record layout' % filename)
+
+    def __repr__(self):
+        return "StreakTable()"
+
+    def __len__(self):
+        return (os.path.getsize(self.filename) - HEADER_SIZE)//STREAK_DTYPE.itemsize
+
+    @contextmanager
+    def locked(self):
+
+        """
+        Context manager that holds an exclusive lock on the table file. Other
+        processes wait for the lock before they write, so everything written
+        inside the block (e.g. a line of the txt file and its record) is
+        written as one step. Nested blocks reuse the lock that is held.
+
+        """
+        if self.handle is not None:
+            yield self
+            return
+        with open(self.filename, 'r+b') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            self.handle = handle
+            try:
+                yield self
+            finally:
+                self.handle = None
+        # Closing the file releases the lock
+
+    def append(self, records):
+
+        """ Appends records (a STREAK_DTYPE array or a list of tuples) to the table. """
+
+        records = np.asarray(records, dtype=STREAK_DTYPE)
+        with self.locked():
+            self.handle.seek(HEADER_SIZE + len(self)*STREAK_DTYPE.itemsize)
+            self.handle.write(records.tobytes())
+            self.handle.flush()
+        # Writes after the last complete record, which also overwrites what
+        # is left of a record whose append was interrupted
+
+    def clear(self):
+
+        """ Removes all records from the table. """
+
+        with self.locked():
+            self.handle.truncate(HEADER_SIZE)
+
+    def read(self):
+
+        """ Returns all records of the table as a read-only memory mapped array. """
+
+        rows = len(self)
+        if rows == 0:
+            return np.zeros(0, STREAK_DTYPE)
+        return np.memmap(self.filename, STREAK_DTYPE, 'r', offset=HEADER_SIZE, shape=(rows,))
+
+
+
+def is_table(filename):
+
+    """ True if filename is a streak table (rather than a txt file). """
+
+    with open(filename, 'rb') as data:
+        return data.read(len(MAGIC)) == MAGIC
+
+
+
+def text_to_table(textfile, tablefile, chunk=100000):
+
+    """
+    Appends the lines of a streak data txt file to a streak table, chunk
+    lines at a time. Returns the number of streaks added.
+
+    """
+    table = StreakTable(tablefile)
+    count = 0
+    rows = []
+    for line_of_data in data_lines(textfile):
+        rows.append(parse_row(line_of_data))
+        if len(rows) == chunk:
+            table.append(rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        table.append(rows)
+        count += len(rows)
+    return count
+
+
+
+def data_lines(textfile):
+
+    """ Generator that yields the lines of a streak data txt file that are not blank. """
+
+    with open(textfile, 'r') as data:
+        for line_of_data in data:
+            if line_of_data.strip():
+                yield line_of_data
+
+
+
+def sync_table(textfile, tablefile, chunk=100000):
+
+    """
+    Opens the streak table of a streak data txt file. Lines of the txt file
+    after the last record of the table are appended to the table first, e.g.
+    when the table is created next to an existing txt file, or a run stopped
+    between writing a line and its record. The table is trusted to be a copy
+    of the txt file up to its last record only if that record matches the
+    line at the same index; otherwise all lines are copied again. Holds the
+    lock of the table throughout, so that no other process writes meanwhile.
+
+    Inputs: name of the streak data txt file, name of the streak table
+    Output: StreakTable
+
+    """
+    table = StreakTable(tablefile)
+    if not os.path.exists(textfile):
+        return table
+    with table.locked():
+        have = len(table)
+        if have:
+            line_of_data = next(itertools.islice(data_lines(textfile), have - 1, None), None)
+            last = table.read()[-1:].tobytes()
+            if line_of_data is None or np.array([parse_row(line_of_data)], STREAK_DTYPE).tobytes() != last:
+                print('%s does not match %s, copying all of its lines again' % (tablefile, textfile))
+                table.clear()
+                have = 0
+        rows = []
+        for line_of_data in itertools.islice(data_lines(textfile), have, None):
+            rows.append(parse_row(line_of_data))
+            if len(rows) == chunk:
+                table.append(rows)
+                rows = []
+        if rows:
+            table.append(rows)
+    return table
+
+
+
+def table_to_text(tablefile, textfile):
+
+    """ Writes a streak table as a streak data txt file. Returns the number of streaks. """
+
+    records = StreakTable(tablefile).read()
+    with open(textfile, 'w') as data:
+        for record in records:
+            data.write(format_row(record))
+    return len(records)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert Fire Opal streak data between txt and table files')
+    parser.add_argument('source', help='Streak data txt file or streak table')
+    parser.add_argument('destination', help='File to write, in the other format')
+    opt = parser.parse_args()
+
+    if is_table(opt.source):
+        print('%d streaks written to %s' % (table_to_text(opt.source, opt.destination), opt.destination))
+    else:
+        print('%d streaks added to %s' % (text_to_table(opt.source, opt.destination), opt.destination))
@@ -12,65 +12,509 @@ Structure:
     extracts data
     
 Requirements:
-    Astrometry.net API client
     fire_opal_settings.py
-    Rawpy, cv2, astropy, datetime, os, scipy, numpy
+    fire_opal_metrics.py, fire_opal_solve.py (and the Astrometry.net API
+    client), fire_opal_table.py
+    Rawpy, cv2, datetime, os, scipy, numpy
 
 
 """
 from fire_opal_settings import *
-import os, rawpy, cv2, datetime, nova_client
+import os, rawpy, cv2, datetime
 import numpy as np
 from scipy.ndimage import gaussian_filter
-from astropy.wcs import WCS
-from astropy.io import fits
+from scipy import ndimage
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from fire_opal_metrics import FrameMetrics, MetricsLog, print_summary
+from fire_opal_solve import StreakCrop, PlateSolveQueue, SolveFailure, SolveUnavailable
+from fire_opal_table import sync_table, parse_row
+import json
 
 
 
-def convert_to_grey(rgbimage):
+frame_metrics = FrameMetrics()
+# Wall time and peak memory of each processing stage of the current image
+# in this process (see fire_opal_metrics.py)
+
+buffers = {}
+# Arrays reused from one image to the next in the same process, so that
+# converting a 24 MP frame does not allocate several new full size arrays
+
+def reusable_buffer(name, shape, dtype):
+    
+    """
+    Returns an uninitialised array with the given shape and dtype. The same
+    array is returned on the next call with the same name, shape and dtype,
+    so its contents are only valid until then.
+    
+    """
+    key = (name, tuple(shape), np.dtype(dtype).str)
+    if key not in buffers:
+        buffers[key] = np.empty(shape, dtype)
+    return buffers[key]
+
+
+
+def convert_to_grey(rgbimage, out=None):
     
     """ This function converts an RGB image to a 
     greyscale image by averaging the RGB values.
     
-    Input: RGB image
-    Output: Greyscale image """
+    Input: RGB image, optional float32 array to write the result into
+    Output: Greyscale image (float32) """
+
+    if out is None:
+        out = np.empty(rgbimage.shape[:2], 'float32')
+    np.sum(rgbimage, axis=2, dtype='float32', out=out)
+    out /= 3*255.0
+    # Summed and divided in place, no float64 copies of the image
+    return out
+
 
-    greyimage = np.sum(rgbimage, axis=2)/(3*255.0)
-    return greyimage
+
+def tile_scores(greyimage, scale=1, tiles=cl_tiles, background=cl_background_thresh, lower=cl_lower_thresh):
+    
+    """
+    This function measures how clear the sky is in each of the sample tiles
+    of a greyscale image. Only the tiles, plus a margin as wide as the
+    Gaussian filter kernel, are filtered, which gives the same result as
+    filtering the whole image.
+    
+    Inputs: Greyscale image, scale of the full resolution image relative to
+    the greyscale image, list of (row1, row2, col1, col2) tiles in full
+    resolution pixels, background and star intensity thresholds
+    Output: List of the percentage of star pixels in each tile
+    
+    """
+    sigma = cl_sigma/float(scale)
+    margin = int(4.0*sigma + 0.5)
+    # Radius of the kernel used by gaussian_filter (truncate=4.0)
+    height, width = greyimage.shape[:2]
+    
+    scores = []
+    for tile in tiles:
+        r1, r2, c1, c2 = [int(edge/scale) for edge in tile]
+        top, bottom = max(0, r1 - margin), min(height, r2 + margin)
+        left, right = max(0, c1 - margin), min(width, c2 + margin)
+        window = greyimage[top:bottom, left:right].astype('float64')
+        
+        c = np.abs(window - gaussian_filter(window, sigma))
+        # Make a defocused copy of original image and subtract from original
+        # A cloudy input image results in pure noise, while a clear input image
+        # has points.
+        
+        subimage = c[r1-top:r2-top, c1-left:c2-left]
+        ignore = np.count_nonzero(subimage<=background)
+        # Count the number of pixels in the subimage below an intensity threshold 
+        # defined as the background. 
+        
+        perc = 100*np.count_nonzero(subimage>lower)/(subimage.size - ignore + 1)
+        # Calculate the percentage of pixels above the brightness threshold, after
+        # low-intensity background pixels have been disregarded.
+        scores.append(perc)
+    
+    return scores
+
+
+
+def clear_tiles(scores):
+    
+    """
+    Returns True if enough tiles contain stars for the image to count as clear.
+    
+    Input: List of tile scores from tile_scores
+    Output: True if clear, False if cloudy
+    
+    """
+    return sum(score > 0. for score in scores) >= cl_min_clear_tiles
 
 
 
-def cloudy_or_clear(greyimage):
+def cloudy_or_clear(greyimage, scale=1, tiles=cl_tiles, background=cl_background_thresh, lower=cl_lower_thresh):
     
     """ 
     This function sorts greyscale images of the night sky into two
     categories: clear or cloudy. Returns Boolean True or False.
     
-    Inputs: Greyscale image, upper intensity bound of background, lower
-    intensity bound for stars, Gaussian filter sigma.
+    Inputs: Greyscale image, scale of the full resolution image relative to
+    the greyscale image (e.g. 4 for a preview that is a quarter of the width
+    of the full image), list of sample tiles, background and star intensity
+    thresholds.
     Output: True if clear, False if cloudy 
     
     """
+    if clear_tiles(tile_scores(greyimage, scale, tiles, background, lower)):
+        return True, greyimage
+    else:
+        return False, greyimage
+    
 
-    c = np.abs(greyimage.astype('float64') - gaussian_filter(greyimage, cl_sigma).astype('float64'))
-    # Make a defocused copy of original image and subtract from original
-    # A cloudy input image results in pure noise, while a clear input image
-    # has points.
+
+def bayer_to_grey(raw, step, bright_fraction=0.01):
     
-    subimage = c[row1:row2, col1:col2]
-    ignore = len(subimage[np.where(subimage<=cl_background_thresh)]) 
-    # Count the number of pixels in the subimage below an intensity threshold 
-    # defined as the background. 
+    """
+    This function makes a greyscale image straight from the Bayer data of a
+    RAW image, without demosaicing. The four Bayer pixels (e.g. RGGB) at the
+    corner of every step x step block make one grey pixel, so step=2 bins
+    the whole image 2x2 and larger steps skip blocks.
     
-    perc = 100*(len(subimage[np.where(subimage>cl_lower_thresh)]))/(500*500 - ignore + 1)
-    # Calculate the percentage of pixels above the brightness threshold, after
-    # low-intensity background pixels have been disregarded.   
+    The red, green (the two green pixels averaged) and blue values are
+    scaled the way raw.postprocess() scales them with its default settings:
+    the daylight white balance of the camera, then automatic brightening so
+    that bright_fraction of the pixels saturate, then the BT.709 gamma
+    curve. As in convert_to_grey, the grey value is the mean of the three,
+    so the cloud check and streak detection thresholds apply to both. The
+    colour matrix of the camera and the image orientation flag are not
+    applied.
     
-    if perc > 0.:
-        return True, greyimage
-    else:
-        return False, greyimage
+    Inputs: rawpy RAW image, step (an even number), fraction of saturated
+    pixels (auto_bright_thr of libraw)
+    Output: greyscale image with values between 0 and 1 (a reusable buffer)
+    
+    """
+    bayer = raw.raw_image_visible
+    rows, cols = bayer.shape[0]//step, bayer.shape[1]//step
+    colours = raw.raw_colors_visible[:2, :2]
+    balance = np.array(raw.daylight_whitebalance, 'float64')
+    if balance[3] == 0:
+        balance[3] = balance[1]
+    if balance.min() <= 0:
+        balance[:] = 1.
+    balance /= balance.min()
+    white = float(raw.white_level)
+    # Colour (0 red, 1 green, 2 blue, 3 second green) of each pixel of a
+    # Bayer block, and white balance multipliers scaled as by libraw
+    
+    planes = {}
+    for i in (0, 1):
+        for j in (0, 1):
+            colour = colours[i, j]
+            black = float(raw.black_level_per_channel[colour])
+            planes.setdefault(1 if colour == 3 else colour, []).append(
+                (bayer[i:rows*step:step, j:cols*step:step], black, balance[colour]/(white - black)))
+    # Pixels of each colour, with their black level and the factor that
+    # scales them to white balanced values between 0 and 1
+    
+    level = 32/8192.
+    for pixels in planes.values():
+        sample = np.concatenate([(plane[::4, ::4] - black)*factor for plane, black, factor in pixels], axis=None)
+        level = max(level, np.percentile(sample, 100*(1 - bright_fraction)))
+    # Automatic brightening: the brightest colour saturates at the level
+    # reached by bright_fraction of its pixels (measured on every 4th block)
+    
+    grey = reusable_buffer('bayer%d' % step, (rows, cols), 'float32')
+    value = reusable_buffer('bayer%d_colour' % step, (rows, cols), 'float32')
+    part = reusable_buffer('bayer%d_part' % step, (rows, cols), 'float32')
+    grey[...] = 0.
+    for pixels in planes.values():
+        value[...] = 0.
+        for plane, black, factor in pixels:
+            scale = factor/(level*len(pixels))
+            np.multiply(plane, scale, out=part, dtype='float32', casting='unsafe')
+            value += part
+            value -= black*scale
+        np.clip(value, 0., 1., out=value)
+        low = value < 0.018
+        np.multiply(value, 4.5, out=part)
+        np.power(value, 0.45, out=value)
+        value *= 1.099
+        value -= 0.099
+        np.copyto(value, part, where=low)
+        # BT.709 gamma curve, linear below 0.018 as in libraw
+        grey += value
+    grey /= 3.
+    return grey
+
+
+
+def decode_image(raw, mode=decode_mode):
+    
+    """
+    This function converts a RAW image into the greyscale image used for
+    cloud checking and streak detection.
+    
+    'full' demosaics at full resolution and averages the RGB values. 'half'
+    demosaics at half resolution (one RGB pixel per Bayer block). 'bin2' skips
+    demosaicing and bins every 2x2 Bayer block into one grey pixel.
+    
+    Inputs: rawpy RAW image, decode mode
+    Outputs: greyscale image with values between 0 and 1 (a reusable buffer),
+    scale of the full resolution image relative to the greyscale image
+    
+    """
+    if mode == 'bin2':
+        with frame_metrics.stage('decode'):
+            return bayer_to_grey(raw, 2), 2
+    
+    with frame_metrics.stage('decode'):
+        if mode == 'half':
+            rgb, scale = raw.postprocess(half_size=True), 2
+        else:
+            rgb, scale = raw.postprocess(), 1
+    with frame_metrics.stage('grey'):
+        grey = convert_to_grey(rgb, reusable_buffer('grey', rgb.shape[:2], 'float32'))
+    del rgb
+    # Frees the RGB image before the next step allocates anything
+    return grey, scale
+
+
+
+def triage_image(raw, mode=triage_mode, reduce=triage_reduce):
+    
+    """
+    This function makes a small greyscale copy of a RAW image for a quick
+    cloudy or clear decision before the full RAW conversion.
+    
+    'thumbnail' decodes the JPEG preview embedded in the NEF at 1/reduce of
+    its size. If the file has no JPEG preview, or mode is 'raw', every
+    2*reduce'th 2x2 block of the Bayer data is averaged instead (see
+    bayer_to_grey).
+    
+    Inputs: rawpy RAW image, triage mode, reduction factor (1, 2, 4 or 8)
+    Outputs: greyscale image with values between 0 and 1, scale of the full
+    resolution image relative to the greyscale image
+    
+    """
+    full_size = max(raw.sizes.width, raw.sizes.height)
+    
+    if mode == 'thumbnail':
+        try:
+            thumb = raw.extract_thumb()
+        except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+            thumb = None
+        if thumb is not None and thumb.format == rawpy.ThumbFormat.JPEG:
+            flags = {1: cv2.IMREAD_GRAYSCALE,
+                     2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                     4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+            preview = cv2.imdecode(np.frombuffer(thumb.data, np.uint8), flags[reduce])
+            # The JPEG decoder skips most of the work when reducing the
+            # image by 2, 4 or 8
+            if preview is not None:
+                return preview/255.0, full_size/float(max(preview.shape))
+    
+    preview = bayer_to_grey(raw, 2*reduce)
+    return preview, full_size/float(max(preview.shape))
+
+
+
+def find_lines(image, scale=1, edge_scale=1.0):
+    
+    """
+    This function finds straight lines in a uint8 greyscale image. First a
+    Canny edge detector creates a binary black and white image in which edges
+    are shown in white. Next the Hough Line Parameters transform calculates
+    which edges are lines and returns the endpoints of the lines.
+    
+    Line lengths and votes are scaled to the resolution of the image, and
+    the Canny thresholds are multiplied by edge_scale.
+    
+    Inputs: uint8 greyscale image, scale of the full resolution image
+    relative to the image, factor for the Canny thresholds
+    Output: array of lines as returned by cv2.HoughLinesP, or None
+    
+    """
+    with frame_metrics.stage('canny'):
+        edges = cv2.Canny(image, definitely_not_an_edge*edge_scale, definitely_an_edge*edge_scale, apertureSize=3)
+    with frame_metrics.stage('hough'):
+        lines = cv2.HoughLinesP(edges, 1, np.pi/180, max(1, int(line_votes/scale)), minLineLength=50/scale, maxLineGap=max(1, 5/scale))
+    if lines is not None:
+        lines = lines.reshape(-1, 1, 4)
+        # Newer versions of OpenCV return an (N, 4) array instead of (N, 1, 4)
+    return lines
+
+
+
+def merge_boxes(boxes):
+    
+    """
+    Merges overlapping (left, top, right, bottom) boxes until none of the
+    remaining boxes overlap.
+    
+    Input: list of boxes
+    Output: list of merged boxes
+    
+    """
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i+1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+
+def detect_lines(image, scale=1, factor=pyramid_factor):
+    
+    """
+    This function finds satellite streaks in two steps. Lines are first
+    searched for in a copy of the image that is factor times smaller, with
+    the Canny thresholds multiplied by pyramid_edge_scale to allow for the
+    lower contrast of thin streaks. Each candidate line gives a region of
+    interest, and the line is then found again at full resolution inside the
+    region only. Most clear images contain no streak, so the full resolution
+    step rarely runs.
+    
+    Inputs: uint8 greyscale image, scale of the full resolution image
+    relative to the image, downsampling factor of the coarse search (1 runs
+    a single search on the whole image)
+    Output: array of lines in the same format as cv2.HoughLinesP, or None
+    
+    """
+    if factor <= 1:
+        return find_lines(image, scale)
+    
+    height, width = image.shape
+    with frame_metrics.stage('pyramid'):
+        coarse = cv2.resize(image, (width//factor, height//factor), interpolation=cv2.INTER_AREA)
+    candidates = find_lines(coarse, scale*factor, pyramid_edge_scale)
+    if candidates is None:
+        return None
+    
+    margin = pyramid_roi_margin
+    boxes = []
+    for x1, y1, x2, y2 in candidates[:, 0]*factor:
+        boxes.append((max(0, min(x1, x2) - margin), max(0, min(y1, y2) - margin),
+                      min(width, max(x1, x2) + factor + margin), min(height, max(y1, y2) + factor + margin)))
+    # Region of interest around each candidate, in full resolution pixels.
+    # Overlapping regions are merged so that no line is found twice.
+    
+    found = []
+    for left, top, right, bottom in merge_boxes(boxes):
+        lines = find_lines(np.ascontiguousarray(image[top:bottom, left:right]), scale)
+        if lines is not None:
+            lines[:, 0, 0::2] += left
+            lines[:, 0, 1::2] += top
+            found.append(lines)
+    
+    if not found:
+        return None
+        # Candidates that are not confirmed at full resolution are discarded
+    return np.concatenate(found)
+
+
+
+def group_segments(lines, scale=1):
+    
+    """
+    If the satellite streak has a width greater than one pixel, HoughLinesP
+    will interpret it as multiple lines placed very close together, and a
+    broken streak gives several lines one after the other. An image can also
+    contain more than one streak (two satellites, or a satellite and an
+    aircraft).
+    
+    This function groups the lines into distinct streaks. Two lines belong to
+    the same streak if their angles differ by less than streak_angle_tol, the
+    midpoint of each is within streak_offset_tol of the other line, and the
+    gap between them along the line is less than streak_gap_tol. Only pairs
+    of lines that come close to each other are compared: points spaced along
+    every line are put in a k-d tree, and lines with points within reach of
+    each other are the candidate pairs. The groups are the connected
+    components of the resulting graph. The endpoints of each streak are the
+    extreme points of its lines along the mean direction.
+    
+    The cost grows with the number of lines, not with its square. If
+    HoughLinesP returns more than max_segments lines (e.g. a noisy image),
+    only the longest are grouped. Streaks shorter than streak_min_length are
+    dropped and at most max_streaks are returned.
+    
+    Inputs: array of lines as returned by cv2.HoughLinesP, scale of the full
+    resolution image relative to the image the lines were found in
+    Output: list of (x1, y1, x2, y2) streak endpoints, longest streak first
+    
+    """
+    segments = lines.reshape(-1, 4).astype('float64')
+    p1, p2 = segments[:, 0:2], segments[:, 2:4]
+    delta = p2 - p1
+    length = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 1e-9)
+    if len(segments) > max_segments:
+        longest = np.argsort(-length)[:max_segments]
+        p1, p2, delta, length = p1[longest], p2[longest], delta[longest], length[longest]
+    n_lines = len(length)
+    u = delta/length[:, None]
+    # Unit vector along each line
+    normal = np.stack([-u[:, 1], u[:, 0]], axis=1)
+    midpoint = (p1 + p2)/2.0
+    
+    gap_tol, offset_tol = streak_gap_tol/scale, streak_offset_tol/scale
+    step = max(gap_tol, 1.0)
+    n_points = np.ceil(length/step).astype(int) + 1
+    line_of_point = np.repeat(np.arange(n_lines), n_points)
+    first_point = np.cumsum(n_points) - n_points
+    fraction = (np.arange(len(line_of_point)) - first_point[line_of_point])/(n_points - 1)[line_of_point]
+    points = p1[line_of_point] + delta[line_of_point]*fraction[:, None]
+    # Points along every line, including both ends, at most step apart
+    
+    drift = np.sin(np.radians(streak_angle_tol))*length.max()/2
+    reach = np.hypot(gap_tol, offset_tol + drift) + step
+    point_pairs = cKDTree(points).query_pairs(reach, output_type='ndarray')
+    i, j = line_of_point[point_pairs[:, 0]], line_of_point[point_pairs[:, 1]]
+    pair = np.unique(np.minimum(i, j)[i != j]*n_lines + np.maximum(i, j)[i != j])
+    i, j = pair//n_lines, pair % n_lines
+    # Lines of the same streak are at most reach apart at their closest
+    # points, so no other pairs need to be compared
+    
+    same_angle = np.abs(np.sum(u[i]*u[j], axis=1)) >= np.cos(np.radians(streak_angle_tol))
+    # Lines are undirected, so angles of a and a+180 degrees are the same
+    
+    def offset(a, b):
+        return np.abs(np.sum(normal[a]*(midpoint[b] - p1[a]), axis=1))
+    same_line = np.maximum(offset(i, j), offset(j, i)) <= offset_tol
+    # Distance of the midpoint of line j from line i, and vice versa
     
+    def gap(a, b):
+        t1 = np.sum(u[a]*(p1[b] - p1[a]), axis=1)
+        t2 = np.sum(u[a]*(p2[b] - p1[a]), axis=1)
+        return np.maximum(np.minimum(t1, t2) - length[a], -np.maximum(t1, t2))
+    close = np.minimum(gap(i, j), gap(j, i)) <= gap_tol
+    # Gap between line a and the projection of line b onto it
+    
+    same_streak = same_angle & same_line & close
+    graph = csr_matrix((np.ones(np.count_nonzero(same_streak)), (i[same_streak], j[same_streak])), shape=(n_lines, n_lines))
+    count, labels = connected_components(graph, directed=False)
+    
+    axis_x = np.bincount(labels, length*(u[:, 0]**2 - u[:, 1]**2), count)
+    axis_y = np.bincount(labels, length*2*u[:, 0]*u[:, 1], count)
+    angle = 0.5*np.arctan2(axis_y, axis_x)
+    direction = np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    # Length weighted mean direction of each streak (angles are doubled so
+    # that opposite directions add up instead of cancelling)
+    sense = np.bincount(labels, np.sum(delta*direction[labels], axis=1), count)
+    direction[sense < 0] *= -1
+    # Points the direction the same way as most of the lines
+    
+    weight = np.bincount(labels, length, count)
+    centre = np.stack([np.bincount(labels, length*midpoint[:, 0], count),
+                       np.bincount(labels, length*midpoint[:, 1], count)], axis=1)/weight[:, None]
+    
+    t = np.concatenate([np.sum((p1 - centre[labels])*direction[labels], axis=1),
+                        np.sum((p2 - centre[labels])*direction[labels], axis=1)])
+    both_labels = np.concatenate([labels, labels])
+    t_lo = np.full(count, np.inf)
+    t_hi = np.full(count, -np.inf)
+    np.minimum.at(t_lo, both_labels, t)
+    np.maximum.at(t_hi, both_labels, t)
+    # Extent of each streak along its direction, measured from its centre
+    
+    start = centre + direction*t_lo[:, None]
+    end = centre + direction*t_hi[:, None]
+    longest = [k for k in np.argsort(t_lo - t_hi) if t_hi[k] - t_lo[k] >= streak_min_length/scale]
+    streaks = [(float(start[k, 0]), float(start[k, 1]), float(end[k, 0]), float(end[k, 1])) for k in longest[:max_streaks]]
+    return streaks
+
 
 
 def line_from_two_points(x1, y1, x2, y2):
@@ -92,168 +536,458 @@ def line_from_two_points(x1, y1, x2, y2):
     b = (y2 - m*x2)
     return m, b
 
-def process_image(datadirectory, file, streaks, processed_images, processed_images_read):
-    raw = rawpy.imread(datadirectory + file)
-    rgb = raw.postprocess()
-    grey = convert_to_grey(rgb)
-    # Reads in RAW image, converts to RGB, converts to grey, in uint8
-    # format for compatibility with cv2 library
+def extract_sources(box, x1, y1, x2, y2, count=source_count, nsigma=source_sigma):
+    
+    """
+    This function finds the brightest stars in a crop. The streak is masked
+    out, pixels more than nsigma times the noise above the background are
+    grouped into connected objects, and the flux weighted centroid and total
+    flux of all objects are measured at once.
+    
+    Inputs: crop (greyscale, 0-255), endpoints of the streak in crop pixels,
+    maximum number of stars, detection threshold in units of the noise
+    Outputs: lists of x and y centroids in crop pixels (0-based), brightest
+    first
+    
+    """
+    sample = box[::4, ::4]
+    background = np.median(sample)
+    noise = 1.4826*np.median(np.abs(sample - background)) + 1e-6
+    # Robust estimates of the background level and the noise from a
+    # subsample of the crop
+    
+    image = box.astype('float32') - background
+    mask = np.zeros(box.shape, 'uint8')
+    cv2.line(mask, (int(round(x1)), int(round(y1))), (int(round(x2)), int(round(y2))), 1, 2*streak_mask_width + 1)
+    image[mask > 0] = 0.
+    # The streak itself is not a star
+    
+    labels, n_objects = ndimage.label(image > nsigma*noise)
+    if n_objects == 0:
+        return [], []
+    index = np.arange(1, n_objects + 1)
+    flux = ndimage.sum(image, labels, index)
+    centroids = np.array(ndimage.center_of_mass(image, labels, index))
+    brightest = np.argsort(flux)[::-1][:count]
+    return centroids[brightest, 1].tolist(), centroids[brightest, 0].tolist()
+
+
+
+png_strategies = {'default': cv2.IMWRITE_PNG_STRATEGY_DEFAULT,
+                  'filtered': cv2.IMWRITE_PNG_STRATEGY_FILTERED,
+                  'huffman': cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY,
+                  'rle': cv2.IMWRITE_PNG_STRATEGY_RLE}
+
+def png_options():
+
+    """ Returns the cv2.imencode parameters for .png crops chosen in the settings. """
+
+    options = []
+    if crop_png_compression is not None:
+        options += [cv2.IMWRITE_PNG_COMPRESSION, crop_png_compression]
+    return options + [cv2.IMWRITE_PNG_STRATEGY, png_strategies[crop_png_strategy]]
+    # The strategy goes last, setting the compression level resets it
+
+
+
+def crop_streak(file, number, greyscale_image, scale, x1, y1, x2, y2):
+    
+    """
+    This function crops the image around one streak and saves the crop for
+    plate solving.
+    
+    Inputs: filename of the image, number of the streak in the image,
+    greyscale image (0-255), scale of the full resolution image relative to
+    the greyscale image, endpoints of the streak in greyscale image pixels
+    Output: StreakCrop
+    
+    """
+    centre_xcoordinate = int(x1 + (np.abs(x1-x2)/2.0))
+    centre_ycoordinate = int(y1 + (np.abs(y1-y2)/2.0))    
+    half_box = int(box_length/scale)
+    x_lo = max(0, centre_xcoordinate - half_box)
+    x_hi = min(centre_xcoordinate + half_box, len(greyscale_image[1]) - 1)
+    y_lo = max(0, centre_ycoordinate - half_box)
+    y_hi = min(centre_ycoordinate + half_box, len(greyscale_image[0]) - 1)
+    box_around_streak = greyscale_image[y_lo : y_hi, x_lo : x_hi]
+    # Calculates the central pixel of the streak and draws a box around it
+    # with sides of length box_length (in full resolution pixels, so
+    # the box covers the same area of sky in every decode mode). This
+    # section of the image around the streak is extracted for
+    # astrometric calibration using nova.astrometry.net.
+    
+    if number == 0:
+        filename = file.replace('.NEF', '_streak.png')
+    else:
+        filename = file.replace('.NEF', '_streak%d.png' % (number+1))
+    # Every streak in an image is cropped and solved separately
+    with frame_metrics.stage('png'):
+        if crop_bits == 16:
+            pixels = np.clip(np.rint(box_around_streak*257.), 0, 65535).astype('uint16')
+        else:
+            pixels = np.clip(np.rint(box_around_streak), 0, 255).astype('uint8')
+        # Quantises the crop (0-255) to 8 or 16 bit integers
+        _, png = cv2.imencode('.png', pixels, png_options())
+        data = png.tobytes()
+        if save_crops:
+            with open(str(detectionpath) + str(filename), 'wb') as crop_file:
+                crop_file.write(data)
+    # Encodes the section of image as a .png image in memory, which is
+    # uploaded to nova.astrometry.net from memory. If save_crops is True,
+    # it is also saved in a folder designated for uploads.
+    
+    uploadpath = str(uploads_from) + str(filename)
+    wcsfile = str(wcs_goes_to) + str(filename).replace('.png', '_wcs.fits')
+    # uploadpath is the location+filename of the .png image
+    # wcsfile is the location+filename of the resulting wcs file 
+    # downloaded from nova.astrometry.net
+    
+    sources = None
+    if solve_mode == 'sources' or plate_solver == 'local' or reuse_wcs:
+        with frame_metrics.stage('sources'):
+            sources = extract_sources(box_around_streak, x1 - x_lo, y1 - y_lo, x2 - x_lo, y2 - y_lo)
+        # Only the star positions are sent to nova.astrometry.net, and the
+        # local solver and the reuse of solutions work from star positions
+    
+    height, width = box_around_streak.shape
+    return StreakCrop(file, number, filename, uploadpath, wcsfile, x1, y1, x2, y2, scale, x_lo, y_lo, width, height, sources, data)
+
+
+
+def streak_row(crop, w):
+    
+    """
+    This function converts the endpoints of a streak into RA/DEC coordinates
+    using the plate solution of its crop, and formats the line of streak data.
+    
+    Inputs: StreakCrop, astropy WCS object of the crop
+    Output: line of streak data
+    
+    """
+    x1, y1, x2, y2, scale = crop.x1, crop.y1, crop.x2, crop.y2, crop.scale
+    (ra1, ra2), (dec1, dec2) = w.wcs_pix2world([x1, x2], [y1, y2], 0, ra_dec_order=True)
+    # Uses wcs header information to calculate RA and DEC coordinates
+    # for the x,y endpoints of the streak (both in one call). RA is always
+    # first, DEC second.
+    
+    x1, y1, x2, y2 = x1*scale, y1*scale, x2*scale, y2*scale
+    # The WCS solution is for the decoded image, so the endpoints are
+    # only scaled back to full resolution coordinates after the
+    # RA/DEC conversion
+    
+    slope, intercept = line_from_two_points(x1, y1, x2, y2)
+    # Fits a line to the streak and records line parameters
+    # for use in post-processing
+    
+    file = crop.file
+    filename_list = list(crop.filename)
+    timestamp = "".join(filename_list[15:21])
+    time = datetime.datetime.strptime(timestamp, '%H%M%S')
+    # Extracts timestamp from filename and converts into a
+    # datetime object
+    
+    endpointa_time = time.time()
+    endpointb_time = (time + datetime.timedelta(seconds=5)).time()
+    # Sets the times for the streak endpoints to be the image
+    # timestamp and the timestamp + shutter speed
+    
+    return '%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % (file, timestamp, ra1, dec1, x1, y1, ra2, dec2, x2, y2, endpointa_time, endpointb_time, slope, intercept)
+
+
+def process_image(datadirectory, file):
+    
+    """
+    This function runs the image processing chain on a single image: cloud
+    check, streak detection and cropping of each streak. It does not plate
+    solve the crops or write to streaks_data or processingrecord, so it can
+    run in a worker process.
+    
+    Inputs: directory containing the image, filename of the image
+    Output: filename, outcome ('clear_streak', 'clear_streakless' or 'cloudy'),
+    list of StreakCrops
+    
+    """
+
+    frame_metrics.start(file)
+    with frame_metrics.stage('read'):
+        raw = rawpy.imread(datadirectory + file)
+    if triage_mode != 'none':
+        with frame_metrics.stage('triage'):
+            preview, scale = triage_image(raw)
+            is_it_clear, _ = cloudy_or_clear(preview, scale, background=triage_background_thresh, lower=triage_lower_thresh)
+        if is_it_clear == False:
+            raw.close()
+            return file, 'cloudy', []
+        # Quick check on a small copy of the image, so that most cloudy
+        # images are never fully converted
+    
+    grey, scale = decode_image(raw)
+    raw.close()
+    # Reads in RAW image and converts to grey, at full resolution or at
+    # half resolution depending on decode_mode
     
-    is_it_clear, greyscale_image = cloudy_or_clear(grey)
-    # Returns True if the image is clear and False if cloudy
-    # Also returns the greyscale image for further processing
+    greyscale_image = grey
+    with frame_metrics.stage('cloud'):
+        scores = tile_scores(greyscale_image, scale)
+    frame_metrics.tile_scores = scores
+    # Printed by process_list, output of the worker processes would be
+    # interleaved
+    is_it_clear = clear_tiles(scores)
+    # True if the image is clear and False if cloudy
 
     if is_it_clear == True:
         
         greyscale_image *= 255.0
-        edges = cv2.Canny(greyscale_image.astype('uint8'), definitely_not_an_edge, definitely_an_edge, apertureSize=3)
-        lines = cv2.HoughLinesP(edges, 1, np.pi/180, line_votes, minLineLength=50, maxLineGap=5)
-        # First a Canny edge detector creates a binary black and white image
-        # in which edges are shown in white. Next the Hough Line Parameters
-        # transform calculates which edges are lines and returns the endpoints
-        # of the lines.
+        grey_uint8 = reusable_buffer('grey_uint8', greyscale_image.shape, 'uint8')
+        np.copyto(grey_uint8, greyscale_image, casting='unsafe')
+        # Truncates to uint8 for the cv2 library, into a reused array
+        lines = detect_lines(grey_uint8, scale)
+        # Canny edge detection and Hough line transform, first on a smaller
+        # copy of the image and then at full resolution around candidate
+        # lines (see detect_lines)
 
         if lines is not None: 
             
-            if lines.shape[0] > 1:
-                
-                # If the satellite streak has a width greater than one pixel,
-                # HoughLineP will interpret it as multiple lines placed very
-                # close together. We solve this by averaging the endpoints of
-                # the lines to get an estimate of the 'real' endpoint.
-                
-                x1 = np.mean(lines[: lines.shape[0],0,0].tolist(), dtype=np.float64)
-                y1 = np.mean(lines[: lines.shape[0],0,1].tolist(), dtype=np.float64)
-                x2 = np.mean(lines[: lines.shape[0],0,2].tolist(), dtype=np.float64)
-                y2 = np.mean(lines[: lines.shape[0],0,3].tolist(), dtype=np.float64)
-
-            elif lines.shape[0] == 1:
-                
-                # If HoughLinesP returns only one line, no further processing
-                # of the endpoints is needed.
-                
-                x1 = float(lines[:,0,0])
-                y1 = float(lines[:,0,1])
-                x2 = float(lines[:,0,2])
-                y2 = float(lines[:,0,3])
-            
-            centre_xcoordinate = int(x1 + (np.abs(x1-x2)/2.0))
-            centre_ycoordinate = int(y1 + (np.abs(y1-y2)/2.0))    
-            x_lo = max(0, centre_xcoordinate - box_length)
-            x_hi = min(centre_xcoordinate + box_length, len(greyscale_image[1]) - 1)
-            y_lo = max(0, centre_ycoordinate - box_length)
-            y_hi = min(centre_ycoordinate + box_length, len(greyscale_image[0]) - 1)
-            box_around_streak = greyscale_image[y_lo : y_hi, x_lo : x_hi]
-            # Calculates the central pixel of the streak and draws a box around it
-            # with sides of length box_length. This section of the image around
-            # the streak is extracted for astrometric calibration using
-            # nova.astrometry.net.
-            
-            filename = file.replace('.NEF', '_streak.png')
-            cv2.imwrite(str(detectionpath) + str(filename), box_around_streak)
-            # Saves section of image as separate .png image in a folder 
-            # designated for uploads to nova.astrometry.net
-            
-            uploadpath = str(uploads_from) + str(filename)
-            wcsfile = str(wcs_goes_to) + str(filename).replace('.png', '_wcs.fits')
-            # Specifies commands used in the nova.astrometry.net parser:
-            # uploadpath is the location+filename of the .png image
-            # wcsfile is the location+filename of the resulting wcs file 
-            # to be downloaded from nova.astrometry.net
-            
-            cmd = '%s %s --apikey %s --upload %s --wcs %s' % (pythonpath, clientpath, apikey, uploadpath, wcsfile)
-            os.system(cmd)
-            # Runs API to nova.astrometry.net. WCS files are returned to the
-            # directory specified in the variable wcs_goes_to
-            
-            hdu = fits.open(wcsfile)
-            w = WCS(hdu[0].header)
-            # Opens wcs file and extracts calibration information from header
-            # Note: Throws a warning that the axes of the WCS file are 0 
-            # when the expected number of axes is 2. This can be ignored,
-            # the program will continue running.
-            
-            ra1, dec1 = w.wcs_pix2world(x1, y1, 0, ra_dec_order=True)
-            ra2, dec2 = w.wcs_pix2world(x2, y2, 0, ra_dec_order=True)
-            # Uses wcs header information to calculate RA and DEC coordinates
-            # for the x,y endpoints of the streak. RA is always first, DEC second.
-                 
-            slope, intercept = line_from_two_points(x1, y1, x2, y2)
-            # Fits a line to the streak and records line parameters
-            # for use in post-processing
-            
-            filename_list = list(filename)
-            timestamp = "".join(filename_list[15:21])
-            time = datetime.datetime.strptime(timestamp, '%H%M%S')
-            # Extracts timestamp from filename and converts into a
-            # datetime object
-            
-            endpointa_time = time.time()
-            endpointb_time = (time + datetime.timedelta(seconds=5)).time()
-            # Sets the times for the streak endpoints to be the image
-            # timestamp and the timestamp + shutter speed
-            
-            streaks.write('%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % (file, timestamp, ra1, dec1, x1, y1, ra2, dec2, x2, y2, endpointa_time, endpointb_time, slope, intercept))                    
-            processed_images.write(str(file) + ' clear_streak' + '\n')
-            processed_images.close()
-            processed_images_read.close()
-            streaks.close()
-            # Writes all extracted data to a .txt file and records
-            # as 'clear_streak'
+            with frame_metrics.stage('group'):
+                streaks = group_segments(lines, scale)
+            crops = []
+            for number, (x1, y1, x2, y2) in enumerate(streaks):
+                crops.append(crop_streak(file, number, greyscale_image, scale, x1, y1, x2, y2))
+            if not crops:
+                return file, 'clear_streakless', []
+                # All segments were shorter than streak_min_length
+            return file, 'clear_streak', crops
+            # Returns the crops to be plate solved, the image is recorded as
+            # 'clear_streak' once all of them are solved
             
         elif lines == None:
             
-            processed_images.write(str(file) + ' clear_streakless' + '\n')
-            processed_images.close()
-            processed_images_read.close()
-            streaks.close()
+            return file, 'clear_streakless', []
             # If image is clear but has no streaks, records as
             # 'clear_streakless'
                         
     else:
             
-        processed_images.write(str(file) + ' cloudy' + '\n')
-        processed_images.close()
-        processed_images_read.close()
-        streaks.close()
+        return file, 'cloudy', []
         # If image is cloudy, records as 'cloudy'
 
 
-def process_list(filelist):
-    for file in filelist:
-    # The first loop processes all images in a directory and returns a text file
-    # containing streak data. The data consists of the filename of
-    # an image containing a satellite streak, together with coordinate and
-    # timestamp information used in the next step to calculate orbits.
-        print(file)
+def process_and_measure(datadirectory, file):
+    
+    """
+    Runs process_image and adds the wall time and peak memory of each
+    processing stage to the result (see FrameMetrics.record).
+    
+    Inputs: directory containing the image, filename of the image
+    Output: filename, outcome, list of StreakCrops, dictionary of
+    measurements
+    
+    """
+    return process_image(datadirectory, file) + (frame_metrics.record(),)
+
+
+class ProcessingRecord:
+    
+    """
+    A ProcessingRecord holds the outcome ('clear_streak', 'clear_streakless'
+    or 'cloudy') of every image listed in the processing record file. The file
+    is read once when the object is created. Lookups use a dictionary, and new
+    outcomes are appended to the end of the file.
+    
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.outcomes = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as record:
+                for line in record:
+                    fields = line.split()
+                    if fields:
+                        self.outcomes[fields[0]] = ' '.join(fields[1:])
+        # Each line of the record is the filename followed by the outcome
+        self.record = open(filename, 'a+')
+    
+    def __contains__(self, file):
+        return file in self.outcomes
+    
+    def __len__(self):
+        return len(self.outcomes)
+    
+    def __repr__(self):
+        return "ProcessingRecord()"
+    
+    def outcome(self, file):
+        return self.outcomes.get(file)
+    
+    def add(self, file, outcome):
+        self.record.write(str(file) + ' ' + outcome + '\n')
+        self.record.flush()
+        # Flushes after every image so that the processing record is up to
+        # date if the program crashes
+        self.outcomes[file] = outcome
+    
+    def close(self):
+        self.record.close()
+
+
+def bounded_map(function, arguments, workers, in_flight):
+    
+    """
+    Runs function on each tuple in arguments using a pool of worker processes
+    and yields the results in the same order as the arguments. At most
+    in_flight tasks are submitted at any time, so a long file list does not
+    queue up every image at once.
+    
+    Inputs: function, iterable of argument tuples, number of worker processes,
+    maximum number of tasks in flight
+    Output: generator of results, in submission order
+    
+    """
+    if workers <= 1:
+        for args in arguments:
+            yield function(*args)
+        return
+        # Runs in the current process, e.g. for debugging
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for args in arguments:
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def process_list(filelist, workers=n_workers, in_flight=max_in_flight):
+    
+    """
+    The first loop processes all images in a directory and returns a text file
+    containing streak data. The data consists of the filename of
+    an image containing a satellite streak, together with coordinate and
+    timestamp information used in the next step to calculate orbits.
+    
+    Images are processed by a pool of worker processes, while the crops of
+    detected streaks are plate solved in a PlateSolveQueue in this process.
+    Solutions arrive in any order, so the streak data of an image is kept
+    until all of its streaks and those of all earlier images are solved, and
+    is then written in the order of the file list (post-processing relies on
+    consecutive images following each other). The image is recorded as
+    'clear_streak' once its streak data is written. If a crop could not be
+    solved because of a network or server error, none of the streak data of
+    its image is written and the image is not recorded, so that it is
+    processed again in the next run. All writes are made by this process.
+    No new image is taken while more than max_pending_solves crops or
+    images are waiting for plate solutions.
+    
+    Inputs: list of image filenames, number of worker processes, maximum
+    number of images in flight (defaults to twice the number of workers)
+    
+    """
+    if not in_flight:
+        in_flight = 2*max(1, workers)
+    pending = max_pending_solves or 4*solves_in_flight
+    
+    record = ProcessingRecord(processingrecord)
+    # Loads the record of images processed so far, this avoids re-processing
+    # of images if there is an error or the program crashes
+    
+    def unprocessed():
+        for file in filelist:
+            if file in record:
+                print(file)
+                print('    already processed')
+                continue
+                # Skips already processed files and continues to next iteration
+            
+            yield datadirectory, file
+    
+    streaks = open(streaks_data,'a+')
+    # Creates a .txt document to store data extracted from image processing loop
+    table = sync_table(streaks_data, streaks_table) if streaks_table else None
+    # Binary copy of the streak data for post-processing, with the lines
+    # written before the table existed
+    metrics = MetricsLog(metricsfile)
+    # Records the time and memory used by each stage for every image
+    solver = PlateSolveQueue()
+    frames = OrderedDict()
+    # Images whose streak data has not been written yet, in submission order,
+    # with the number of crops still waiting for a plate solution and the
+    # streak data of the solved crops
+    
+    def write_solutions(block=False):
+        for crop, solution in solver.completed(block):
+            frame = frames[crop.file]
+            try:
+                w, times = solution.result()
+            except SolveUnavailable as error:
+                print('    %s could not be solved now (%s)' % (crop.filename, error))
+                frame['retry'] = True
+            except SolveFailure:
+                print('    %s could not be solved' % crop.filename)
+                # The streak is skipped if the crop cannot be plate solved
+            else:
+                frame['rows'][crop.number] = streak_row(crop, w)
+                metrics.add_crop(crop.file, crop.number, times)
+            frame['unsolved'] -= 1
         
-        streaks = open(streaks_data,'a+')
-        # Creates a .txt document to store data extracted from image processing loop
-        processed_images = open(processingrecord, 'a+')
-        # Creates a .txt document to store filenames of images as they are processed
-        processed_images_read = open(processingrecord, 'r')   
-        # Read-only version of processing record
-        already_processed = processed_images_read.read().split()
+        while frames and next(iter(frames.values()))['unsolved'] == 0:
+            file, frame = frames.popitem(last=False)
+            if frame['retry']:
+                print('    %s will be processed again in the next run' % file)
+                continue
+            lines = [frame['rows'][number] for number in sorted(frame['rows'])]
+            if table is None:
+                streaks.writelines(lines)
+                streaks.flush()
+            else:
+                with table.locked():
+                    streaks.writelines(lines)
+                    streaks.flush()
+                    table.append([parse_row(line_of_data) for line_of_data in lines])
+                # Other tasks writing to the same files wait for the lock, so
+                # the table stays a copy of the txt file line by line
+            record.add(file, 'clear_streak')
+            # Streak data is written before the image is marked as processed
+    
+    try:
+        for result in bounded_map(process_and_measure, unprocessed(), workers, in_flight):
+            file, outcome, crops, measurements = result
+            print(file)
+            if measurements['tile_scores'] is not None:
+                print('    tile scores: %s' % ', '.join('%.3f' % score for score in measurements['tile_scores']))
+            if measurements['peak_memory'] is not None:
+                print('    worker %d peak memory %.0f MB' % (measurements['pid'], measurements['peak_memory']))
+            metrics.add(measurements)
+            if crops:
+                frames[file] = {'unsolved': len(crops), 'rows': {}, 'retry': False}
+                for crop in crops:
+                    solver.submit(crop)
+            else:
+                record.add(file, outcome)
+            write_solutions()
+            while len(solver) > pending or len(frames) > pending:
+                write_solutions(block=True)
+                # Waits for solutions before taking the next image
         
-        if file in already_processed:   
-            processed_images.close()
-            processed_images_read.close()
-            streaks.close()
-            print('    already processed')
-            continue
-            # Skips already processed files and continues to next iteration
-            
-        else: 
-            process_image(datadirectory, file, streaks, processed_images, processed_images_read)
-            
-            # If the processing throws an error for any reason, the program will
-            # write ERROR to the processing record and continue to the
-            # next iteration
-    #            print(str(e))
-    #            processed_images.write(str(file) + ' ERROR' + '\n')
-    #            processed_images.close()
-    #            processed_images_read.close()
-    #            streaks.close()
+        while len(solver):
+            write_solutions(block=True)
+            # Waits for the remaining plate solutions
+        solver.close()
+    finally:
+        solver.close(wait=False)
+        record.close()
+        streaks.close()
+        metrics.close()
+    
+    summary = metrics.summary()
+    print_summary(summary)
+    if metricssummary:
+        with open(metricssummary, 'a+') as summaryfile:
+            summaryfile.write(json.dumps(summary) + '\n')
+    # Per-run summary: 50th and 95th percentile time of each stage and
+    # frames per second
+
             
 if __name__ == "__main__":                
     filelist = os.listdir(datadirectory)
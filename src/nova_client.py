@@ -14,12 +14,15 @@ import os
 import sys
 import time
 import base64
-from urllib.request import urlopen, Request, HTTPError
-from urllib.parse import urlencode, quote
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.application import MIMEApplication
-from email.encoders import encode_noop, encode_base64
+import heapq
+import random
+import select
+import threading
+import http.client
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError
+from urllib.request import urlopen, HTTPError
+from urllib.parse import urlencode, quote, urlsplit, urlunsplit
+import uuid
 import json
 
 
@@ -42,19 +45,365 @@ class RequestError(Exception):
     pass
 
 
+class JobFailure(Exception):
+    pass
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data request body with two parts: the request JSON
+    and a file. The file is sent as raw bytes (no base64), read from disk
+    in chunks while the request is being sent, so memory use does not
+    depend on the size of the file. `data` can be given instead of a
+    file on disk. The body can be iterated more than once (e.g. when a
+    request is sent again).
+    """
+    chunk_size = 64*1024
+
+    def __init__(self, json, filename, data=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        self.head = (
+            '--%s\r\n'
+            'Content-Type: text/plain\r\n'
+            'Content-disposition: form-data; name="request-json"\r\n'
+            '\r\n'
+            '%s\r\n'
+            '--%s\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            'Content-disposition: form-data; name="file"; filename="%s"\r\n'
+            '\r\n' % (boundary, json, boundary, filename)).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.filename = filename
+        self.data = data
+        if data is None:
+            self.size = os.path.getsize(filename)
+        else:
+            self.size = len(data)
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        if self.data is not None:
+            yield self.data
+        else:
+            with open(self.filename, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        yield self.tail
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections to one server, shared by all threads of
+    a Client. At most `maxsize` requests are sent at the same time; idle
+    connections are kept open and reused by the next request.
+    """
+
+    def __init__(self, url, maxsize=8, timeout=60):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxsize)
+
+    def _connect(self):
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+        send = conn.send
+
+        def send_and_mark(data):
+            conn.sent = True
+            send(data)
+        conn.send = send_and_mark
+        # conn.sent records whether any bytes of the current request have
+        # been handed to the socket
+        return conn
+
+    def _idle_connection(self):
+        """
+        Returns an idle connection that the server has not closed, or None.
+        An idle keep-alive connection has nothing to read unless the server
+        has closed it, so a readable one is dropped.
+        """
+        with self.lock:
+            while self.idle:
+                conn = self.idle.pop()
+                if conn.sock is not None and \
+                        not select.select([conn.sock], [], [], 0)[0]:
+                    return conn
+                conn.close()
+        return None
+
+    def request(self, method, path, body=None, headers={}):
+        """
+        Sends one request and returns (status, headers, body) of the
+        response. If a kept-alive connection fails because the server has
+        closed it in the meantime, the request is sent again on a new
+        connection, but only if it is a GET or none of its bytes had been
+        sent, so that an upload is never submitted twice.
+        """
+        with self.slots:
+            conn = self._idle_connection()
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            conn.sent = False
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused or (method != 'GET' and conn.sent):
+                    raise
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                conn = self._connect()
+                conn.sent = False
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+            return response.status, response.msg, data
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class Poller(object):
+    """
+    Polls the status of many submissions and jobs. One background thread
+    keeps the schedule; each tracked id is polled on its own schedule: the
+    interval starts at min_interval, grows by `backoff` after every poll
+    that shows no progress (up to max_interval) and is randomised by +/-
+    `jitter`, so fast solves are noticed quickly and slow ones do not flood
+    the server. Polls that are due are sent by a pool of `workers` threads
+    (by default the concurrency of the client), so that the polls of
+    hundreds of solves in flight do not wait for each other's round trips.
+
+    add_submission and add_job return a concurrent.futures.Future that
+    resolves to the job id when the job succeeds, or raises JobFailure if
+    the submission or job fails (or takes longer than `timeout` seconds).
+    Callers can block on future.result() or use future.add_done_callback.
+    close stops polling and fails every Future that has not resolved yet,
+    so that no caller waits for a poll that will never be sent.
+    """
+
+    def __init__(self, client, min_interval=1., max_interval=60.,
+                 backoff=1.5, jitter=0.2, timeout=None, workers=None):
+        self.client = client
+        self.workers = workers or getattr(client, 'concurrency', 8)
+        self.pool = None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.queue = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pending = set()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.queue)
+
+    def close(self):
+        """
+        Stops the scheduler thread and the poll workers and fails every
+        Future that has not resolved yet with JobFailure.
+        """
+        with self.condition:
+            self.closed = True
+            self.queue = []
+            pending = list(self.pending)
+            self.condition.notify()
+        for future in pending:
+            self._fail(future, JobFailure('poller closed'))
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _fail(self, future, error):
+        try:
+            future.set_exception(error)
+        except InvalidStateError:
+            pass
+            # Resolved (or cancelled) in the meantime by a poll worker
+
+    def add_submission(self, sub_id):
+        return self._add('submission', sub_id)
+
+    def add_job(self, job_id):
+        return self._add('job', job_id)
+
+    def _add(self, kind, item_id):
+        future = Future()
+        with self.condition:
+            self.pending.add(future)
+        future.add_done_callback(self._resolved)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        self._schedule(time.time(), [kind, item_id, self.min_interval,
+                                     deadline, future])
+        return future
+
+    def _resolved(self, future):
+        with self.condition:
+            self.pending.discard(future)
+
+    def _schedule(self, due, entry):
+        with self.condition:
+            if self.closed:
+                self._fail(entry[4], JobFailure('poller closed'))
+                return
+            self.counter += 1
+            heapq.heappush(self.queue, (due, self.counter, entry))
+            if self.thread is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def _next_poll(self, entry, progress):
+        interval = entry[2]
+        if progress:
+            interval = self.min_interval
+        else:
+            interval = min(interval*self.backoff, self.max_interval)
+        entry[2] = interval
+        spread = random.uniform(1. - self.jitter, 1. + self.jitter)
+        self._schedule(time.time() + interval*spread, entry)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (
+                        not self.queue or self.queue[0][0] > time.time()):
+                    delay = self.queue[0][0] - time.time() if self.queue else None
+                    self.condition.wait(delay)
+                if self.closed:
+                    return
+                due, count, entry = heapq.heappop(self.queue)
+            try:
+                self.pool.submit(self._poll_or_fail, entry)
+            except RuntimeError as e:
+                self._fail(entry[4], JobFailure('poll not sent: %s' % e))
+                self.close()
+                return
+                # The pool no longer takes polls (e.g. at interpreter exit),
+                # so none of the other entries would be polled either
+            # An entry is back in the queue only after its poll, so it is
+            # never polled twice at the same time
+
+    def _poll_or_fail(self, entry):
+        try:
+            self._poll(entry)
+        except Exception as e:
+            self._fail(entry[4], e)
+
+    def _poll(self, entry):
+        kind, item_id, interval, deadline, future = entry
+        if future.done():
+            return
+        if deadline is not None and time.time() > deadline:
+            future.set_exception(
+                JobFailure('%s %s timed out' % (kind, item_id)))
+            return
+
+        if kind == 'submission':
+            stat = self.client.sub_status(item_id, justdict=True) or {}
+            jobs = [j for j in stat.get('jobs', []) if j is not None]
+            if len(jobs):
+                print('Submission %s: selecting job id %s' % (item_id, jobs[0]))
+                entry[0], entry[1] = 'job', jobs[0]
+                self._next_poll(entry, progress=True)
+            elif stat.get('error_message') or stat.get('processing_finished'):
+                future.set_exception(JobFailure(
+                    'submission %s failed: %s' % (
+                        item_id, stat.get('error_message', 'no job'))))
+            else:
+                self._next_poll(entry, progress=False)
+        else:
+            stat = self.client.job_status(item_id, justdict=True) or {}
+            status = stat.get('status', '')
+            if status == 'success':
+                future.set_result(item_id)
+            elif status == 'failure':
+                future.set_exception(JobFailure('job %s failed' % item_id))
+            else:
+                self._next_poll(entry, progress=False)
+
+
 class Client(object):
     default_url = 'http://nova.astrometry.net/api/'
 
     def __init__(
         self,
-        apiurl=default_url
+        apiurl=default_url,
+        concurrency=8,
+        timeout=60
     ):
         self.session = None
         self.apiurl = apiurl
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.pool = ConnectionPool(apiurl, concurrency, timeout)
+        self.poller = None
+        self.lock = threading.Lock()
 
     def get_url(self, service):
         return self.apiurl + service
 
+    def http_request(self, url, data=None, headers={}):
+        """
+        Sends a GET (or POST, if data is given) through the connection pool
+        and returns (status, body). Redirects to another scheme or host
+        (e.g. http to https) move the client to the new address.
+        """
+        for attempt in range(3):
+            parts = urlsplit(url)
+            path = urlunsplit(('', '', parts.path, parts.query, ''))
+            status, reply_headers, body = self.pool.request(
+                'GET' if data is None else 'POST', path, data, headers)
+            location = reply_headers.get('Location')
+            if status not in (301, 302, 303, 307, 308) or not location:
+                return status, body
+            new = urlsplit(location)
+            if new.netloc and (new.scheme, new.netloc) != (
+                    self.pool.scheme, self.pool.host):
+                print('Redirected to', location)
+                self.apiurl = urlunsplit(
+                    (new.scheme, new.netloc, urlsplit(self.apiurl).path,
+                     '', ''))
+                self.pool.close()
+                self.pool = ConnectionPool(
+                    self.apiurl, self.concurrency, self.timeout)
+            url = urlunsplit((self.pool.scheme, self.pool.host, new.path,
+                              new.query, ''))
+            if status == 303:
+                data = None
+        return status, body
+
     def send_request(self, service, args={}, file_args=None):
         '''
         service: string
@@ -67,51 +416,9 @@ class Client(object):
 
         # If we're sending a file, format a multipart/form-data
         if file_args is not None:
-            m1 = MIMEBase('text', 'plain')
-            m1.add_header(
-                'Content-disposition', 'form-data; name="request-json"')
-            m1.set_payload(json)
-
-            m2 = MIMEApplication(file_args[1], 'octet-stream', encode_base64)
-            m2.add_header(
-                'Content-disposition',
-                'form-data; name="file"; filename="%s"' % file_args[0])
-
-            mp = MIMEMultipart('form-data', None, [m1, m2])
-
-            # Make a custom generator to format it the way we need.
-            from io import StringIO
-            from email.generator import Generator
-
-            class MyGenerator(Generator):
-                def __init__(self, fp, root=True):
-                    Generator.__init__(self, fp, mangle_from_=False,
-                                       maxheaderlen=0)
-                    self.root = root
-
-                def _write_headers(self, msg):
-                    # We don't want to write the top-level headers;
-                    # they go into Request(headers) instead.
-                    if self.root:
-                        return
-                    # We need to use \r\n line-terminator, but Generator
-                    # doesn't provide the flexibility to override, so we
-                    # have to copy-n-paste-n-modify.
-                    for h, v in msg.items():
-                        print(('%s: %s\r\n' % (h, v)), end='', file=self._fp)
-                    # A blank line always separates headers from body
-                    print('\r\n', end='', file=self._fp)
-
-                # The _write_multipart method calls "clone" for the
-                # subparts.  We hijack that, setting root=False
-                def clone(self, fp):
-                    return MyGenerator(fp, root=False)
-
-            fp = StringIO()
-            g = MyGenerator(fp)
-            g.flatten(mp)
-            data = fp.getvalue().encode('utf-8')
-            headers = {'Content-type': mp.get('Content-type')}
+            data = MultipartBody(json, file_args[0], file_args[1])
+            headers = {'Content-type': data.content_type,
+                       'Content-Length': str(len(data))}
 
         else:
             # Else send x-www-form-encoded
@@ -119,11 +426,13 @@ class Client(object):
             data = urlencode(data).encode('utf-8')
             headers = {}
 
-        request = Request(url=url, headers=headers, data=data)
+        if file_args is None:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
 
         try:
-            f = urlopen(request)
-            txt = f.read()
+            status, txt = self.http_request(url, data, headers)
+            if status >= 400:
+                raise HTTPError(url, status, txt[:200], None, None)
             print('Got json:', txt)
             result = json2python(txt)
             print('Got result:', result)
@@ -142,6 +451,8 @@ class Client(object):
     def login(self, apikey):
         args = {'apikey': apikey}
         result = self.send_request('login', args)
+        if result is None:
+            raise RequestError('login failed')
         sess = result.get('session')
         print('Got session:', sess)
         if not sess:
@@ -168,7 +479,8 @@ class Client(object):
             ('crpix_center', None, bool),
             ('x', None, list),
             ('y', None, list),
-            # image_width, image_height
+            ('image_width', None, int),
+            ('image_height', None, int),
         ]:
             if key in kwargs:
                 val = kwargs.pop(key)
@@ -185,13 +497,16 @@ class Client(object):
         result = self.send_request('url_upload', args)
         return result
 
-    def upload(self, fn, **kwargs):
+    def upload(self, fn, data=None, **kwargs):
+        """
+        Uploads the file fn, streamed from disk, or the bytes `data` under
+        the name fn.
+        """
         args = self._get_upload_args(**kwargs)
         try:
-            f = open(fn, 'rb')
-            result = self.send_request('upload', args, (fn, f.read()))
+            result = self.send_request('upload', args, (fn, data))
             return result
-        except IOError:
+        except (IOError, OSError):
             print('File %s does not exist' % fn)
             raise
 
@@ -263,11 +578,13 @@ class Client(object):
         url = self.apiurl.replace(
             '/api/', '/user_image/%s/tags/new/' % image_id)
         data = {'text': tag}
-        request = Request(url, urlencode(data).encode())
+        headers = {'Content-type': 'application/x-www-form-urlencoded'}
         try:
             print('add tag', tag, 'to image', image_id)
-            f = urlopen(request)
-            txt = f.read()
+            status, txt = self.http_request(
+                url, urlencode(data).encode(), headers)
+            if status >= 400:
+                raise HTTPError(url, status, txt[:200], None, None)
             print('Got json:', txt)
         except HTTPError as e:
             print('Setting of new tag failed with HTTPError', e)
@@ -289,6 +606,77 @@ class Client(object):
             return result
         return result.get('status')
 
+    def get_poller(self):
+        """
+        Returns the Poller shared by all callers of this client, creating
+        one with default intervals if none has been set.
+        """
+        with self.lock:
+            if self.poller is None:
+                self.poller = Poller(self)
+            return self.poller
+
+    def close(self):
+        """
+        Closes the Poller (failing the waits that have not finished) and
+        the idle connections of the client. The closed Poller is kept, so
+        that threads still using the client fail at their next wait.
+        """
+        with self.lock:
+            poller = self.poller
+        if poller is not None:
+            poller.close()
+        self.pool.close()
+
+    def wait_for_job(self, sub_id):
+        """
+        Waits until the submission has a job and the job has finished.
+        Returns the job id if the job succeeded; raises JobFailure if it
+        failed.
+        """
+        return self.get_poller().add_submission(sub_id).result()
+
+    def wcs_file(self, job_id):
+        """
+        Returns the contents of the wcs.fits file of a solved job.
+        """
+        url = self.apiurl.replace('/api/', '/wcs_file/%i' % int(job_id))
+        status, data = self.http_request(url)
+        if status >= 400:
+            raise RequestError('wcs_file/%s: HTTP status %s' % (job_id, status))
+        return data
+
+    def calibration(self, job_id):
+        """
+        Returns the calibration of a solved job as a dictionary (ra, dec,
+        radius, pixscale, orientation, parity...).
+        """
+        result = self.send_request('jobs/%s/calibration' % job_id)
+        if result is None:
+            raise RequestError('jobs/%s/calibration failed' % job_id)
+        return result
+
+    def solve(self, fn, **kwargs):
+        """
+        Uploads an image, waits for it to be solved and returns the job id.
+        """
+        upres = self.upload(fn, **kwargs)
+        if upres is None or upres.get('status') != 'success':
+            raise RequestError('upload of %s failed: %s' % (fn, upres))
+        return self.wait_for_job(upres['subid'])
+
+    def solve_xy(self, x, y, image_width, image_height, **kwargs):
+        """
+        Submits a list of source positions (FITS 1-based pixel coordinates,
+        brightest first) instead of an image, waits for it to be solved
+        and returns the job id.
+        """
+        upres = self.submit(x=list(x), y=list(y), image_width=image_width,
+                            image_height=image_height, **kwargs)
+        if upres is None or upres.get('status') != 'success':
+            raise RequestError('source list upload failed: %s' % upres)
+        return self.wait_for_job(upres['subid'])
+
     def jobs_by_tag(self, tag, exact):
         exact_option = 'exact=yes' if exact else ''
         result = self.send_request(
@@ -494,27 +882,15 @@ if __name__ == '__main__':
                 print("Can't --wait without a submission id or job id!")
                 sys.exit(-1)
 
-            while True:
-                stat = c.sub_status(opt.sub_id, justdict=True)
-                print('Got status:', stat)
-                jobs = stat.get('jobs', [])
-                if len(jobs):
-                    for j in jobs:
-                        if j is not None:
-                            break
-                    if j is not None:
-                        print('Selecting job id', j)
-                        opt.solved_id = j
-                        break
-                time.sleep(5)
-
-        while True:
-            stat = c.job_status(opt.solved_id, justdict=True)
-            print('Got job status:', stat)
-            if stat.get('status', '') in ['success']:
-                success = (stat['status'] == 'success')
-                break
-            time.sleep(5)
+        poller = Poller(c, min_interval=2., max_interval=30.)
+        try:
+            if opt.solved_id is None:
+                opt.solved_id = poller.add_submission(opt.sub_id).result()
+            else:
+                poller.add_job(opt.solved_id).result()
+        except JobFailure as e:
+            print('Solving failed:', e)
+            sys.exit(-1)
 
     if opt.solved_id:
         # we have a jobId for retrieving results
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the nova.astrometry.net API, for testing the throughput
+of nova_client and the Fire Opal plate solving without the public server.
+
+The server implements the endpoints used by nova_client: login, upload
+(multipart file or source list), submissions/<id>, jobs/<id>,
+jobs/<id>/calibration and wcs_file/<id>. It does not solve anything: every
+job returns the same canned calibration and WCS file. Solving is simulated
+by a fixed number of solver slots, each job taking a random time, so jobs
+queue up like on the real server. Request latency, the solve time, the
+fraction of failed jobs and of failed requests, and the length of the queue
+are configurable.
+
+Usage:
+    python nova_server.py --port 8080
+    serves until interrupted; set nova_url = 'http://127.0.0.1:8080/api/' in
+    fire_opal_settings.py to plate solve against it
+    python nova_server.py --benchmark --solves 200 --concurrency 16
+    measures solves per second and solve latency through nova_client.Client
+
+Requirements:
+    nova_client.py (for the benchmark)
+    astropy, http.server, email
+
+"""
+import argparse, contextlib, hashlib, heapq, io, json, os, random, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+import nova_client
+
+
+CALIBRATION = {'ra': 335.4, 'dec': 46.2, 'radius': 4.2, 'pixscale': 24.6,
+               'orientation': 88.1, 'parity': -1.0}
+# A typical solution of a Fire Opal crop
+
+
+
+def canned_wcs_file(calibration, width=1200, height=1200):
+
+    """ Returns the bytes of a WCS FITS file matching the calibration. """
+
+    scale = calibration['pixscale']/3600.
+    orientation = np.radians(calibration['orientation'])
+    parity = calibration['parity']
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [calibration['ra'], calibration['dec']]
+    w.wcs.crpix = [(width + 1)/2., (height + 1)/2.]
+    w.wcs.cd = scale*np.array([[parity*np.cos(orientation), np.sin(orientation)],
+                               [-parity*np.sin(orientation), np.cos(orientation)]])
+    data = io.BytesIO()
+    fits.PrimaryHDU(header=w.to_header()).writeto(data)
+    return data.getvalue()
+
+
+
+class NovaServer(ThreadingHTTPServer):
+
+    """
+    A NovaServer answers the astrometry.net API on (host, port). Each upload
+    becomes a submission that waits for one of `workers` solver slots, after
+    queue_delay seconds at least. Its job appears when solving starts and
+    takes solve_time seconds on average (log-normal, with spread as the
+    standard deviation of the logarithm). A fraction failure_rate of the jobs
+    fail, and a fraction error_rate of all requests get an HTTP 500 reply.
+    Uploads are refused while max_queue submissions are waiting. Every
+    request is delayed by latency seconds.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), workers=8, solve_time=5., spread=0.5,
+                 queue_delay=0., failure_rate=0., error_rate=0., max_queue=None,
+                 latency=0., calibration=CALIBRATION, seed=None):
+        ThreadingHTTPServer.__init__(self, address, NovaHandler)
+        self.solve_time = solve_time
+        self.spread = spread
+        self.queue_delay = queue_delay
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.max_queue = max_queue
+        self.latency = latency
+        self.calibration = calibration
+        self.wcs_data = canned_wcs_file(calibration)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.slots = [0.]*workers
+        # Time at which each solver slot becomes free
+        self.submissions = {}
+        self.jobs = {}
+        self.sessions = set()
+        self.requests = 0
+
+    def __repr__(self):
+        return "NovaServer()"
+
+    @property
+    def url(self):
+        return 'http://%s:%d/api/' % self.server_address[:2]
+
+    def submit(self):
+
+        """ Queues a new submission, returns its id or None if the queue is full. """
+
+        now = time.time()
+        with self.lock:
+            if self.max_queue is not None:
+                waiting = sum(1 for sub in self.submissions.values() if sub['start'] > now)
+                if waiting >= self.max_queue:
+                    return None
+            start = max(now + self.queue_delay, heapq.heappop(self.slots))
+            finish = start + self.random.lognormvariate(np.log(self.solve_time), self.spread)
+            heapq.heappush(self.slots, finish)
+            sub_id = job_id = len(self.submissions) + 1
+            success = self.random.random() >= self.failure_rate
+            self.submissions[sub_id] = {'created': now, 'start': start, 'job': job_id}
+            self.jobs[job_id] = {'start': start, 'finish': finish, 'success': success}
+            return sub_id
+
+    def submission_status(self, sub_id):
+        sub = self.submissions.get(sub_id)
+        if sub is None:
+            return None
+        now = time.time()
+        job = self.jobs[sub['job']]
+        started = now >= sub['start']
+        finished = now >= job['finish']
+        return {'user': 1,
+                'processing_started': started,
+                'processing_finished': finished,
+                'user_images': [sub_id] if started else [],
+                'jobs': [sub['job']] if started else [],
+                'job_calibrations': [[sub['job'], sub['job']]] if finished and job['success'] else []}
+
+    def job_status(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        now = time.time()
+        if now < job['start']:
+            return None
+        if now < job['finish']:
+            return 'solving'
+        return 'success' if job['success'] else 'failure'
+
+
+
+class NovaHandler(BaseHTTPRequestHandler):
+
+    """ Answers one connection to a NovaServer (HTTP/1.1, kept alive). """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type='application/json'):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def request_json(self, body):
+
+        """ Returns the request-json of a multipart or urlencoded body, and the uploaded file. """
+
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=HTTP).parsebytes(
+                b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+            parts = {}
+            for part in message.iter_parts():
+                parts[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+            return json.loads(parts.get('request-json', b'{}').decode('utf-8')), parts.get('file')
+        form = parse_qs(body.decode('utf-8'))
+        return json.loads(form.get('request-json', ['{}'])[0]), None
+
+    def do_GET(self):
+        self.handle_request(b'')
+
+    def do_POST(self):
+        self.handle_request(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def handle_request(self, body):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.random.random() < server.error_rate:
+            return self.reply(500, b'Internal Server Error', 'text/plain')
+
+        path = self.path.split('?')[0].strip('/').split('/')
+        if path[0] == 'wcs_file' and len(path) == 2:
+            if server.job_status(int(path[1])) != 'success':
+                return self.reply(404, b'Not Found', 'text/plain')
+            return self.reply(200, server.wcs_data, 'application/fits')
+        if path[0] != 'api' or len(path) < 2:
+            return self.reply(404, b'Not Found', 'text/plain')
+
+        try:
+            args, upload = self.request_json(body)
+        except ValueError:
+            return self.reply(200, {'status': 'error', 'errormessage': 'no json'})
+        service = path[1:]
+
+        if service == ['login']:
+            session = uuid.uuid4().hex
+            with server.lock:
+                server.sessions.add(session)
+            return self.reply(200, {'status': 'success', 'message': 'authenticated user', 'session': session})
+
+        if service == ['upload'] or service == ['url_upload']:
+            if args.get('session') not in server.sessions:
+                return self.reply(200, {'status': 'error', 'errormessage': 'no session with key'})
+            if upload is None and service == ['upload'] and 'x' not in args:
+                return self.reply(200, {'status': 'error', 'errormessage': 'no file'})
+            sub_id = server.submit()
+            if sub_id is None:
+                return self.reply(200, {'status': 'error', 'errormessage': 'queue full'})
+            digest = hashlib.sha1(upload or json.dumps(args).encode('utf-8')).hexdigest()
+            return self.reply(200, {'status': 'success', 'subid': sub_id, 'hash': digest})
+
+        if service[0] == 'submissions' and len(service) == 2:
+            status = server.submission_status(int(service[1]))
+            if status is None:
+                return self.reply(404, b'Not Found', 'text/plain')
+            return self.reply(200, status)
+
+        if service[0] == 'jobs' and len(service) in (2, 3):
+            status = server.job_status(int(service[1]))
+            if status is None:
+                return self.reply(404, b'Not Found', 'text/plain')
+            if len(service) == 2:
+                return self.reply(200, {'status': status})
+            if service[2] == 'calibration' and status == 'success':
+                return self.reply(200, server.calibration)
+        return self.reply(404, b'Not Found', 'text/plain')
+
+
+
+def run_benchmark(solves=100, concurrency=16, poll_min=0.1, poll_max=2., **server_options):
+
+    """
+    Starts a NovaServer and plate solves `solves` small uploads through
+    nova_client.Client from `concurrency` threads, like the plate solving
+    queue of Fire Opal: upload, wait for the job with the shared Poller and
+    fetch the calibration.
+
+    Inputs: number of solves, number of threads, polling intervals, options
+    of NovaServer
+    Output: dictionary of results
+
+    """
+    server = NovaServer(**server_options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = nova_client.Client(server.url, concurrency)
+    client.poller = nova_client.Poller(client, poll_min, poll_max)
+    data = os.urandom(50000)
+    # About the size of a .png crop
+
+    def solve(number):
+        start = time.perf_counter()
+        try:
+            job_id = client.solve('crop%d.png' % number, data=data)
+            client.calibration(job_id)
+            return time.perf_counter() - start, True
+        except (nova_client.RequestError, nova_client.JobFailure):
+            return time.perf_counter() - start, False
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.login('benchmark')
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(solve, range(solves)))
+        elapsed = time.perf_counter() - start
+    # The client prints every request and reply
+    server.shutdown()
+    server.server_close()
+    client.pool.close()
+
+    latency = [seconds for seconds, solved in results if solved]
+    percentiles = np.percentile(latency, [50, 95, 99, 100]) if latency else [float('nan')]*4
+    return {'solves': solves,
+            'solved': len(latency),
+            'seconds': elapsed,
+            'solves_per_second': len(latency)/elapsed,
+            'p50': percentiles[0],
+            'p95': percentiles[1],
+            'p99': percentiles[2],
+            'max': percentiles[3],
+            'requests': server.requests,
+            'requests_per_solve': server.requests/float(solves)}
+
+
+
+def print_results(results):
+
+    """ Prints the results of run_benchmark. """
+
+    print('%d of %d solved in %.1f s: %.2f solves/s, %d requests (%.1f per solve)' % (
+        results['solved'], results['solves'], results['seconds'], results['solves_per_second'],
+        results['requests'], results['requests_per_solve']))
+    print('solve latency (s): p50 %.2f, p95 %.2f, p99 %.2f, max %.2f' % (
+        results['p50'], results['p95'], results['p99'], results['max']))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for the nova.astrometry.net API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to serve on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to serve on (0 for any)')
+    parser.add_argument('--workers', type=int, default=8, help='Jobs solved at the same time')
+    parser.add_argument('--solve-time', type=float, default=5., help='Mean solve time in seconds')
+    parser.add_argument('--spread', type=float, default=0.5, help='Spread of the log of the solve time')
+    parser.add_argument('--queue-delay', type=float, default=0., help='Least time before a job starts')
+    parser.add_argument('--failure-rate', type=float, default=0., help='Fraction of jobs that fail')
+    parser.add_argument('--error-rate', type=float, default=0., help='Fraction of requests answered with HTTP 500')
+    parser.add_argument('--max-queue', type=int, help='Submissions allowed to wait for a solver')
+    parser.add_argument('--latency', type=float, default=0., help='Delay of every request in seconds')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument('--benchmark', action='store_true', help='Run the client benchmark instead of serving')
+    parser.add_argument('--solves', type=int, default=100, help='Number of solves in the benchmark')
+    parser.add_argument('--concurrency', type=int, default=16, help='Client threads in the benchmark')
+    parser.add_argument('--poll-min', type=float, default=0.1, help='Shortest polling interval of the benchmark')
+    parser.add_argument('--poll-max', type=float, default=2., help='Longest polling interval of the benchmark')
+    parser.add_argument('--json', help='Also write the benchmark results to this .json file')
+    opt = parser.parse_args()
+
+    options = dict(workers=opt.workers, solve_time=opt.solve_time, spread=opt.spread,
+                   queue_delay=opt.queue_delay, failure_rate=opt.failure_rate,
+                   error_rate=opt.error_rate, max_queue=opt.max_queue,
+                   latency=opt.latency, seed=opt.seed)
+    if opt.benchmark:
+        results = run_benchmark(opt.solves, opt.concurrency, opt.poll_min, opt.poll_max, **options)
+        print_results(results)
+        if opt.json:
+            with open(opt.json, 'w') as jsonfile:
+                json.dump(results, jsonfile, indent=2)
+    else:
+        server = NovaServer((opt.host, opt.port), **options)
+        print('Serving the astrometry.net API at %s' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()